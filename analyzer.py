@@ -53,6 +53,7 @@ password = None
 
 [shakemap]
 projection = EPSG:3311
+cache_grids = True
 
 [shaking_time]
 function = eewperformance.userdisplay.shaking_time_vs
@@ -63,6 +64,9 @@ vp_kmps = 6.1
 function = eewperformance.shakemap.mmi_via_gmpe_gmice
 gmpe = ASK2014
 gmice = default
+cache_memory_mb = 1024
+# Maximum size of rasters stored in [files] mmi_cache_dir
+cache_disk_mb = 4096
 
 [alerts]
 alert_latency_sec = 0.0
@@ -107,6 +111,7 @@ raster = True
 [files]
 event_dir = ./data/[EVENTID]/
 analysis_cache_dir = ./data/cache/
+mmi_cache_dir = ./data/cache/mmi/
 plots_dir = ./data/plots/
 report = report.pdf
 
@@ -150,6 +155,7 @@ class Event(object):
             self.showProgress = True
 
         self.db = None
+        self.sink = None
         self.shakemap = None
         self.alerts = None
         self.event = None
@@ -211,8 +217,9 @@ class Event(object):
                 gmiceGrid = None
         else:
             raise ValueError("Unknown GMICE '{}'.".format(gmice))
+        cacheDir = os.path.join(dataDir, "grid_cache") if self.config.getboolean("shakemap", "cache_grids") else None
         self.shakemap = shakemap.ShakeMap(gmiceFn)
-        self.shakemap.load(filename)
+        self.shakemap.load(filename, cacheDir)
         self.shakemap.gmiceGrid = gmiceGrid
 
         # Analsis DB data (event and alerts)
@@ -291,7 +298,7 @@ class Event(object):
             "mmi_threshold": mmiAlertThreshold,
             "alert_latency_sec": self.config.getfloat("alerts", "alert_latency_sec"),
             })
-        self.db.add_performance(stats, replace=True)
+        (self.sink or self.db).add_performance(stats, replace=True)
 
         return
 
@@ -324,17 +331,33 @@ class Event(object):
             "alert_latency_sec": self.config.getfloat("alerts", "alert_latency_sec"),
             }
         
+        # Only write analysis rasters used in maps and figures (alert thresholds in configuration).
+        rasterLabel = analysis_utils.analysis_event_label(self.config, self.eqId)
+
         costSavings = perfmetrics.CostSavings(self.config)
+
+        # Group magnitude thresholds by first alert used; thresholds
+        # in a group select the same alerts and give identical results.
+        magGroups = {}
         for magnitude in magThresholds:
-            for mmi in mmiThresholds:
-                if self.showProgress:
-                    print("Processing event {event[event_id]} with alert thresholds M{mag} and MMI {mmi} and alert latency {latency:3.1f}s ...".format(event=self.event, mag=magnitude, mmi=mmi, latency=alertLatency))
-
-                stats = costSavings.compute(self.event, self.shakemap, self.alerts, self.shakingTime, self.populationDensity, magnitude, mmi)
-                stats.update(statsExtra)
-                stats["magnitude_threshold"] = magnitude
-                stats["mmi_threshold"] = mmi
-                self.db.add_performance(stats, replace=True)
+            ialert = costSavings.first_alert_index(self.alerts, self.shakingTime, magnitude)
+            magGroups.setdefault(ialert, []).append(magnitude)
+
+        for ialert, magnitudes in magGroups.items():
+            if self.showProgress:
+                print("Processing event {event[event_id]} with alert thresholds M{magMin}-{magMax} and MMI {mmiMin}-{mmiMax} and alert latency {latency:3.1f}s ...".format(event=self.event, magMin=magnitudes[0], magMax=magnitudes[-1], mmiMin=mmiThresholds[0], mmiMax=mmiThresholds[-1], latency=alertLatency))
+
+            rasters = [(mag, mmi) for mag in magnitudes for mmi in mmiThresholds if analysis_utils.analysis_event_label(self.config, self.eqId, mag, mmi) == rasterLabel]
+            metrics = costSavings.sweep(self.event, self.shakemap, self.alerts, self.shakingTime, self.populationDensity, magnitudes[0], mmiThresholds, rasters)
+            statsList = []
+            for magnitude in magnitudes:
+                for mmi, metricsMMI in zip(mmiThresholds, metrics):
+                    stats = dict(metricsMMI)
+                    stats.update(statsExtra)
+                    stats["magnitude_threshold"] = magnitude
+                    stats["mmi_threshold"] = mmi
+                    statsList.append(stats)
+            (self.sink or self.db).add_performance_many(statsList, replace=True)
         return
 
     def _plot_maps(self):
@@ -412,21 +435,36 @@ class EEWAnalyzeApp(object):
             
         # Event processing
         if args.process_events or args.optimize_events or args.plot_event_maps or args.plot_event_figures or args.all:
+            # Store alert matches once here, so the events only read them.
+            db = analysisdb.AnalysisData(self.config.get("files", "analysis_db"))
+            if db.schema_version() >= analysisdb.SCHEMA_VERSION:
+                db.match_events(self.config.get("shakealert.production", "server"), self.config.options("events"))
             if args.nthreads <= 0:
                 for eqId in self.config.options("events"):
                     event = Event(args, self.config, eqId)
                     event.process()
             else:
-                pool = multiprocessing.Pool(args.nthreads)
-                result = []
-                for eqId in self.config.options("events"):
-                    event = Event(args, self.config, eqId)
-                    r = pool.apply_async(event_worker, args=(event,))
-                    result.append(r)
-                for r in result:
-                    r.get()
-                pool.close()
-                pool.join()
+                # Workers send performance stats to a single writer
+                # instead of contending for the database lock.
+                manager = multiprocessing.Manager()
+                writer = analysisdb.PerformanceWriter(analysisdb.AnalysisData(self.config.get("files", "analysis_db")), manager.Queue())
+                try:
+                    pool = multiprocessing.Pool(args.nthreads)
+                    result = []
+                    for eqId in self.config.options("events"):
+                        event = Event(args, self.config, eqId)
+                        event.sink = writer.sink()
+                        r = pool.apply_async(event_worker, args=(event,))
+                        result.append(r)
+                    for r in result:
+                        r.get()
+                    pool.close()
+                    pool.join()
+                finally:
+                    try:
+                        writer.close()
+                    finally:
+                        manager.shutdown()
 
         # Summary maps and figures
         if args.plot_summary_maps or args.all:
@@ -437,6 +475,8 @@ class EEWAnalyzeApp(object):
         # Generate report
         if args.generate_report or args.all:
             self.generate_report("True" if args.generate_report == "summary" else False)
+
+        analysisdb.close_connections()
         return
 
     def initialize(self, config_filenames):
@@ -14,6 +14,7 @@ import logging
 import datetime
 import dateutil.parser
 import gzip
+import itertools
 import argparse
 from lxml import etree
 
@@ -39,20 +40,44 @@ server = eew2demo
 username = None
 password = None
 
+[shakealert.dmlog]
+# Messages to keep when reading DM logs (comma separated list or 'all').
+# Analyses only use live new and update messages.
+categories = all
+message_types = all
+
 [shakemap]
 preferred_order = ci
 
 [files]
 dmlogs_dir = ./data/dmlogs/[SERVER]/
+dmalerts_archive_dir = ./data/dmalerts/[SERVER]/
 event_dir = ./data/[EVENTID]/
 analysis_db = ./data/analysisdb.sqlite
 """
 
+# ----------------------------------------------------------------------
+def dmlog_worker(filename, filters=None):
+    """Parse DM log.
+
+    :type filename: str
+    :param filename: Name of local file with DM log.
+
+    :type filters: dict
+    :param filters: Messages to keep (see shakealert.DMLogXML).
+
+    :returns: Tuple of filename and list of alerts in DM log.
+    """
+    return (filename, shakealert.DMLogXML(filters=filters).load(filename))
+
+
 # ----------------------------------------------------------------------
 class DownloaderApp(object):
     """
     Download data (DM logs, ShakeMaps, ComCat events) needed for analysis of ShakeAlert performance.
     """
+
+    ALERTS_BATCH_SIZE = 5000 # Number of alerts per insert into analysis database
     
     def __init__(self):
         """Constructor.
@@ -81,6 +106,9 @@ class DownloaderApp(object):
             dateEnd = dateutil.parser.parse(endStr).date()
             self._fetch_eewalerts(dateBegin, dateEnd)
 
+        if args.archive_eewalerts:
+            self._archive_eewalerts(numWorkers=args.num_workers)
+
         if args.fetch_events or args.all:
             self._fetch_comcat_events()
 
@@ -92,19 +120,29 @@ class DownloaderApp(object):
         if args.db_init or args.all:
             self._db_init(args.db_init)
 
+        if args.db_migrate:
+            self._db_migrate()
+
         if args.db_summary or args.all:
             self._db_summary(args.db_summary)
 
         if args.db_populate or args.all:
-            if "eew_alerts" in args.db_populate or args.db_populate == "all" or args.all:
-                self._db_populate_eewalerts(all=args.db_populate != "new_eew_alerts", replace=args.db_replace_rows)
+            if args.db_populate in ("all_eew_alerts", "new_eew_alerts", "all") or args.all:
+                self._db_populate_eewalerts(all=args.db_populate != "new_eew_alerts", replace=args.db_replace_rows, numWorkers=args.num_workers)
+            if args.db_populate == "archived_eew_alerts":
+                self._db_populate_eewalerts_archive(replace=args.db_replace_rows)
             if args.db_populate == "comcat_events" or args.db_populate == "all" or args.all:
                 self._db_populate_events(replace=args.db_replace_rows)
             if args.db_populate == "comcat_shakemaps" or args.db_populate == "all" or args.all:
                 self._db_populate_shakemaps(replace=args.db_replace_rows)
 
+        if args.db_match:
+            self._db_match()
+
         if args.show_matches or args.all:
             self._show_matches()
+
+        analysisdb.close_connections()
         return
 
     def _fetch_eewalerts(self, dateBegin, dateEnd):
@@ -302,13 +340,22 @@ class DownloaderApp(object):
         logging.getLogger(__name__).info(self.db.tables_info())
         return
 
+    def _db_migrate(self):
+        """Update analysis database to current schema.
+        """
+        if self.showProgress:
+            print("Migrating analysis database...")
+        if not self.db.migrate() and self.showProgress:
+            print("Analysis database schema is up to date.")
+        return
+
     def _db_summary(self, style="tables_info"):
         """Show summary of analysis database contents.
         """
         if style == "tables_info":
             print(self.db.tables_info())
         else:
-            print(self.db.summary())
+            self.db.summary(sys.stdout, groupBy="event" if style == "summary_events" else None)
         return
 
     def _db_populate_events(self, replace=False):
@@ -356,7 +403,7 @@ class DownloaderApp(object):
             sys.stdout.write("\n")
         return
     
-    def _db_populate_eewalerts(self, all=False, replace=False):
+    def _db_populate_eewalerts(self, all=False, replace=False, numWorkers=0):
         """
         """
         import glob
@@ -389,20 +436,158 @@ class DownloaderApp(object):
                 files.remove(filename)
 
         # Read DM logs
-        dmlog = shakealert.DMLogXML(config=self.config)
         numFiles = len(files)
         if numFiles > 0:
             logging.getLogger(__name__).info("Processing {:d} DM logs starting with {:s}.".format(numFiles, files[0]))
         else:
             logging.getLogger(__name__).info("No DM logs found.")
-        for iFile,filename in enumerate(files):
+        dmlog = shakealert.DMLogXML(config=self.config)
+        if numWorkers <= 0:
+            results = ((filename, dmlog.iter_alerts(filename)) for filename in files)
+        else:
+            # Workers parse the logs; alerts are added to the database
+            # in this process as each log finishes, in any order.
+            import multiprocessing
+            import functools
+            pool = multiprocessing.Pool(numWorkers)
+            results = pool.imap_unordered(functools.partial(dmlog_worker, filters=dmlog.filters), files)
+        numInserted = 0
+        numDuplicates = 0
+        try:
+            for iFile,(filename, alerts) in enumerate(results):
+                if self.showProgress:
+                    sys.stdout.write("\rProcessing DM logs...{:d}%".format(((iFile+1)*100)//numFiles))
+                    sys.stdout.flush()
+                (inserted, duplicates) = self._add_alerts(alerts, replace)
+                logging.getLogger(__name__).debug("Added {:d} new alerts and found {:d} existing alerts in {:s}.".format(inserted, duplicates, filename))
+                numInserted += inserted
+                numDuplicates += duplicates
+        finally:
+            if numWorkers > 0:
+                pool.close()
+                pool.join()
+        if self.showProgress:
+            sys.stdout.write("\n")
+        logging.getLogger(__name__).info("Added {:d} new alerts and found {:d} existing alerts.".format(numInserted, numDuplicates))
+        return
+
+    def _add_alerts(self, alerts, replace=False):
+        """Add alerts to analysis database in batches.
+
+        :type alerts: iterable of dict
+        :param alerts: Alerts to add to database.
+
+        :type replace: bool
+        :param replace: If True, replace existing alerts.
+
+        :returns: Tuple of number of alerts inserted and number of alerts already in database.
+        """
+        numInserted = 0
+        numDuplicates = 0
+        alerts = iter(alerts)
+        while True:
+            batch = list(itertools.islice(alerts, self.ALERTS_BATCH_SIZE))
+            if not batch:
+                break
+            (inserted, duplicates) = self.db.add_alerts(batch, replace)
+            numInserted += inserted
+            numDuplicates += duplicates
+        return (numInserted, numDuplicates)
+
+    def _archive_eewalerts(self, numWorkers=0):
+        """Write monthly columnar archives of alerts in DM logs.
+        """
+        import glob
+        import re
+        
+        if self.showProgress:
+            print("Archiving ShakeAlert DM alerts...")
+
+        server = self.config.get("shakealert.production", "server")    
+        logsDir = self.config.get("files", "dmlogs_dir").replace("[SERVER]", server)
+        archiveDir = self.config.get("files", "dmalerts_archive_dir").replace("[SERVER]", server)
+        files = sorted(glob.glob(os.path.join(logsDir, "dmevent_*.log.gz")))
+        numFiles = len(files)
+        if numFiles == 0:
+            logging.getLogger(__name__).info("No DM logs found.")
+            return
+
+        # Group logs by month using date in filename.
+        months = []
+        for filename in files:
+            year, month = map(int, re.search("dmevent_([0-9]{4})([0-9]{2})", filename).groups())
+            months.append((year, month))
+
+        dmlog = shakealert.DMLogXML(config=self.config)
+        if numWorkers <= 0:
+            results = ((filename, dmlog.load(filename)) for filename in files)
+        else:
+            # Keep logs in order so each month is complete when written.
+            import multiprocessing
+            import functools
+            pool = multiprocessing.Pool(numWorkers)
+            results = pool.imap(functools.partial(dmlog_worker, filters=dmlog.filters), files)
+        try:
+            alerts = []
+            for iFile,(filename, fileAlerts) in enumerate(results):
+                if self.showProgress:
+                    sys.stdout.write("\rArchiving DM logs...{:d}%".format(((iFile+1)*100)//numFiles))
+                    sys.stdout.flush()
+                alerts += fileAlerts
+                if iFile+1 == numFiles or months[iFile+1] != months[iFile]:
+                    dirname = shakealert.archive_dirname(archiveDir, *months[iFile])
+                    shakealert.AlertsArchive.from_alerts(alerts).save(dirname)
+                    logging.getLogger(__name__).info("Wrote {:d} alerts to archive '{}'.".format(len(alerts), dirname))
+                    alerts = []
+        finally:
+            if numWorkers > 0:
+                pool.close()
+                pool.join()
+        if self.showProgress:
+            sys.stdout.write("\n")
+        return
+
+    def _db_populate_eewalerts_archive(self, replace=False):
+        """Add alerts from monthly archives to analysis database.
+        """
+        import glob
+        
+        if self.showProgress:
+            print("Updating ShakeAlert DM alerts in analysis database from archives...")
+
+        server = self.config.get("shakealert.production", "server")    
+        archiveDir = self.config.get("files", "dmalerts_archive_dir").replace("[SERVER]", server)
+        dirs = sorted(glob.glob(os.path.join(archiveDir, "dmalerts_[0-9]*")))
+        numDirs = len(dirs)
+        if numDirs == 0:
+            logging.getLogger(__name__).info("No DM alert archives found.")
+        numInserted = 0
+        numDuplicates = 0
+        for iDir,dirname in enumerate(dirs):
             if self.showProgress:
-                sys.stdout.write("\rProcessing DM logs...{:d}%".format(((iFile+1)*100)//numFiles))
+                sys.stdout.write("\rProcessing DM alert archives...{:d}%".format(((iDir+1)*100)//numDirs))
                 sys.stdout.flush()
-            alerts = dmlog.load(filename)
-            self.db.add_alerts(alerts, replace)
+            archive = shakealert.AlertsArchive.load(dirname)
+            (inserted, duplicates) = self._add_alerts(archive.alerts(), replace)
+            logging.getLogger(__name__).debug("Added {:d} new alerts and found {:d} existing alerts in {:s}.".format(inserted, duplicates, dirname))
+            numInserted += inserted
+            numDuplicates += duplicates
         if self.showProgress:
             sys.stdout.write("\n")
+        logging.getLogger(__name__).info("Added {:d} new alerts and found {:d} existing alerts.".format(numInserted, numDuplicates))
+        return
+
+    def _db_match(self):
+        """Match ShakeAlert DM alerts to ComCat events and store matches in analysis database.
+        """
+        if self.showProgress:
+            print("Matching ShakeAlert DM alerts to ComCat events...")
+        if self.db.schema_version() < analysisdb.SCHEMA_VERSION:
+            logging.getLogger(__name__).warning("Analysis database schema version {} is older than version {}. Run with --db-migrate to store matches.".format(self.db.schema_version(), analysisdb.SCHEMA_VERSION))
+            return
+        matches = self.db.match_events(self.config.get("shakealert.production", "server"))
+        numMatched = sum([len(rowids) > 0 for rowids in matches.values()])
+        logging.getLogger(__name__).info("Matched alerts to {:d} of {:d} ComCat events.".format(numMatched, len(matches)))
         return
 
     def _show_matches(self):
@@ -446,12 +631,16 @@ class DownloaderApp(object):
         parser.add_argument("--config", action="store", dest="config")
         parser.add_argument("--show-parameters", action="store_true", dest="show_parameters")
         parser.add_argument("--fetch-eewalerts", action="store", dest="fetch_eewalerts", default=None, metavar="DATE_BEGIN,DATE_END")
+        parser.add_argument("--archive-eewalerts", action="store_true", dest="archive_eewalerts")
         parser.add_argument("--fetch-events", action="store_true", dest="fetch_events")
         parser.add_argument("--fetch-shakemaps", action="store_true", dest="fetch_shakemaps")
         parser.add_argument("--db-init", action="store", dest="db_init", choices=["eew_alerts", "comcat_events", "comcat_shakemaps", "performance", "all"])
-        parser.add_argument("--db-summary", action="store", dest="db_summary", default=None, choices=[None, "tables_info", "summary"])
-        parser.add_argument("--db-populate", action="store", dest="db_populate", choices=["all_eew_alerts", "new_eew_alerts", "comcat_events", "comcat_shakemaps", "all"])
+        parser.add_argument("--db-migrate", action="store_true", dest="db_migrate")
+        parser.add_argument("--db-summary", action="store", dest="db_summary", default=None, choices=[None, "tables_info", "summary", "summary_events"])
+        parser.add_argument("--db-populate", action="store", dest="db_populate", choices=["all_eew_alerts", "new_eew_alerts", "archived_eew_alerts", "comcat_events", "comcat_shakemaps", "all"])
         parser.add_argument("--db-replace-rows", action="store_true", dest="db_replace_rows")
+        parser.add_argument("--num-workers", action="store", type=int, dest="num_workers", default=0)
+        parser.add_argument("--db-match", action="store_true", dest="db_match")
         parser.add_argument("--show-matches", action="store_true", dest="show_matches")
         parser.add_argument("--all", action="store_true", dest="all")
         parser.add_argument("--quiet", action="store_false", dest="show_progress", default=True)
@@ -6,9 +6,11 @@
 # ======================================================================
 #
 
+import os
 import sqlite3
 import sys
 import logging
+import threading
 import datetime
 import dateutil.parser
 import pytz
@@ -17,6 +19,7 @@ import numpy
 
 TABLES = [
     ("eew_alerts", [
+        "alert_id INTEGER PRIMARY KEY",
         "server TEXT NOT NULL",
         "event_id INTEGER NOT NULL",
         "category TEXT NOT NULL",
@@ -30,6 +33,8 @@ TABLES = [
         "depth_km REAL NOT NULL",
         "origin_time TEXT NOT NULL",
         "num_stations INTEGER DEFAULT 0",
+        "timestamp_us INTEGER",
+        "origin_time_us INTEGER",
         "UNIQUE(server, event_id, version, category) ON CONFLICT FAIL",
     ]),
     ("comcat_events", [
@@ -41,6 +46,7 @@ TABLES = [
         "magnitude REAL NOT NULL",
         "magnitude_type TEXT DEFAULT Mw",
         "description TEXT",
+        "origin_time_us INTEGER",
         "UNIQUE(event_id) ON CONFLICT FAIL",
     ]),
     ("comcat_shakemaps", [
@@ -87,18 +93,160 @@ TABLES = [
 ]
 
 
+# Columns of unique constraint identifying alerts.
+ALERTS_KEY = ("server", "event_id", "version", "category")
+
+# Version of schema objects beyond TABLES, stored in PRAGMA user_version.
+#
+# Version 1: Indices and R*Tree index for alerts.
+# Version 2: Integer timestamps (microseconds since the epoch).
+# Version 3: Table of alerts matching ComCat events.
+# Version 4: Stable alert ids (alert_id), used by the R*Tree index and matches.
+SCHEMA_VERSION = 4
+
+# Seconds since the epoch for origin time text.
+EPOCH_SQL = "((julianday({}) - 2440587.5)*86400.0)"
+
+# Integer timestamp columns (microseconds since the epoch) and the
+# corresponding text columns.
+EPOCH_COLUMNS = {
+    "eew_alerts": (("timestamp_us", "timestamp"), ("origin_time_us", "origin_time")),
+    "comcat_events": (("origin_time_us", "origin_time"),),
+}
+
+# Schema objects replaced in later schema versions.
+SCHEMA_OBSOLETE = [
+    "DROP INDEX IF EXISTS eew_alerts_event",
+    "DROP INDEX IF EXISTS eew_alerts_origin",
+    "DROP TRIGGER IF EXISTS eew_alerts_rtree_update",
+]
+
+# Tables derived from a table that are dropped along with it.
+DERIVED_TABLES = {
+    "eew_alerts": ["eew_alerts_rtree", "event_alert_matches"],
+    "comcat_events": ["event_alert_matches"],
+}
+
+# Indices, R*Tree index, and triggers maintaining the R*Tree index.
+#
+# The R*Tree index stores 32-bit floats, so the origin time bounds
+# are rounded outward to about 2 minutes; queries must apply exact
+# predicates as well.
+SCHEMA = [
+    "CREATE INDEX IF NOT EXISTS eew_alerts_event_us ON eew_alerts(event_id, server, category, timestamp_us)",
+    "CREATE INDEX IF NOT EXISTS eew_alerts_origin_us ON eew_alerts(category, message_type, origin_time_us)",
+    "CREATE INDEX IF NOT EXISTS eew_alerts_timestamp_us ON eew_alerts(timestamp_us)",
+    "CREATE INDEX IF NOT EXISTS performance_lookup ON performance(comcat_id, eew_server, gmpe, fragility, alert_latency_sec)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS eew_alerts_rtree USING rtree(id, min_lon, max_lon, min_lat, max_lat, min_ot, max_ot)",
+    "CREATE TRIGGER IF NOT EXISTS eew_alerts_rtree_insert AFTER INSERT ON eew_alerts BEGIN "
+    "INSERT OR REPLACE INTO eew_alerts_rtree VALUES(new.alert_id, new.longitude, new.longitude, new.latitude, new.latitude, {ot}, {ot}); END".format(ot=EPOCH_SQL.format("new.origin_time")),
+    "CREATE TRIGGER IF NOT EXISTS eew_alerts_rtree_location AFTER UPDATE OF longitude, latitude, origin_time ON eew_alerts BEGIN "
+    "DELETE FROM eew_alerts_rtree WHERE id=old.alert_id; "
+    "INSERT OR REPLACE INTO eew_alerts_rtree VALUES(new.alert_id, new.longitude, new.longitude, new.latitude, new.latitude, {ot}, {ot}); END".format(ot=EPOCH_SQL.format("new.origin_time")),
+    "CREATE TRIGGER IF NOT EXISTS eew_alerts_rtree_delete AFTER DELETE ON eew_alerts BEGIN "
+    "DELETE FROM eew_alerts_rtree WHERE id=old.alert_id; END",
+    # Alerts matching each ComCat event (see AnalysisData.match_events()). Events
+    # without matching alerts have a single row with a NULL alert.
+    "CREATE TABLE IF NOT EXISTS event_alert_matches (comcat_id TEXT NOT NULL, eew_server TEXT NOT NULL, position INTEGER NOT NULL, alert_id INTEGER, PRIMARY KEY(comcat_id, eew_server, position))",
+    # Any change to alerts may change any match; changes to an event only change its matches.
+    "CREATE TRIGGER IF NOT EXISTS eew_alerts_matches_insert AFTER INSERT ON eew_alerts BEGIN DELETE FROM event_alert_matches; END",
+    "CREATE TRIGGER IF NOT EXISTS eew_alerts_matches_update AFTER UPDATE ON eew_alerts BEGIN DELETE FROM event_alert_matches; END",
+    "CREATE TRIGGER IF NOT EXISTS eew_alerts_matches_delete AFTER DELETE ON eew_alerts BEGIN DELETE FROM event_alert_matches; END",
+    "CREATE TRIGGER IF NOT EXISTS comcat_events_matches_insert AFTER INSERT ON comcat_events BEGIN DELETE FROM event_alert_matches WHERE comcat_id=new.event_id; END",
+    "CREATE TRIGGER IF NOT EXISTS comcat_events_matches_update AFTER UPDATE ON comcat_events BEGIN DELETE FROM event_alert_matches WHERE comcat_id=old.event_id OR comcat_id=new.event_id; END",
+    "CREATE TRIGGER IF NOT EXISTS comcat_events_matches_delete AFTER DELETE ON comcat_events BEGIN DELETE FROM event_alert_matches WHERE comcat_id=old.event_id; END",
+]
+
+# Journal mode set when creating or migrating a database. WAL
+# journaling lets readers proceed while another process writes. It is
+# stored in the database file, so we do not set it when only opening a
+# database; databases on network filesystems should not use WAL, so
+# set the journal mode back to DELETE for them.
+JOURNAL_MODE = "WAL"
+
+# Pragmas applied to each new connection.
+PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-65536", # KiB
+    "PRAGMA mmap_size=268435456", # bytes
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA recursive_triggers=ON", # fire delete triggers for INSERT OR REPLACE
+)
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.UTC)
+
+# Open connections, keyed by process id, thread id, and filename.
+CONNECTIONS = {}
+
+
+def get_connection(filename):
+    """Get connection to database for this process and thread.
+
+    Connections are created the first time they are requested and
+    reused by later operations. Keying by process id ensures forked
+    worker processes do not share the parent's connection.
+
+    :type filename: str
+    :param filename: Filename of SQLite database
+    """
+    key = (os.getpid(), threading.get_ident(), filename)
+    if not key in CONNECTIONS:
+        connection = sqlite3.connect(filename, timeout=20.0, cached_statements=256)
+        connection.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            connection.execute(pragma)
+        CONNECTIONS[key] = connection
+    return CONNECTIONS[key]
+
+
+# Number of open operations for each connection, keyed by id of connection.
+OPERATION_DEPTHS = {}
+
+
+def close_connections():
+    """Close connections opened by this process and thread.
+
+    Closing the last connection to a database checkpoints the WAL file.
+    """
+    for key in [k for k in CONNECTIONS.keys() if k[:2] == (os.getpid(), threading.get_ident())]:
+        CONNECTIONS.pop(key).close()
+    return
+
+
+def epoch_us(value):
+    """Get microseconds since the epoch for time.
+
+    :type value: datetime.datetime or str
+    :param value: Time (naive times are UTC).
+
+    :returns: Integer microseconds since the epoch.
+    """
+    if isinstance(value, str):
+        value = dateutil.parser.parse(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=pytz.UTC)
+    delta = value - EPOCH
+    return (delta.days*86400 + delta.seconds)*1000000 + delta.microseconds
+
+
 class Operation(object):
     """Database operation object for minimizing locking behavior in database queries.
 
     Based on Tranaction object in beets library
     (https://github.com/beetbox/beets/blob/master/beets/dbcore/db.py)
 
+    The connection is reused across operations; we commit and close
+    the cursor at the end of each operation so locks are released as
+    soon as possible. Operations nested on the same connection are part
+    of the outermost operation, which commits or, if an exception was
+    raised, rolls back.
     """
 
     def __init__(self, filename):
-        self.connection = sqlite3.connect(filename, timeout=20.0)
-        self.connection.row_factory = sqlite3.Row
+        self.connection = get_connection(filename)
         self.cursor = self.connection.cursor()
+        key = id(self.connection)
+        OPERATION_DEPTHS[key] = OPERATION_DEPTHS.get(key, 0) + 1
         return    
     
     def __enter__(self):
@@ -106,16 +254,159 @@ class Operation(object):
     
     def __exit__(self, exc_type, exc_value, traceback):
         if self.connection:
-            self.connection.commit()
-            self.connection.close()
+            self.cursor.close()
+            key = id(self.connection)
+            OPERATION_DEPTHS[key] -= 1
+            if OPERATION_DEPTHS[key] == 0:
+                del OPERATION_DEPTHS[key]
+                if exc_type is None:
+                    self.connection.commit()
+                else:
+                    self.connection.rollback()
         self.connection = None
         self.cursor = None
         return
 
 
+class PerformanceSink(object):
+    """Queue-backed replacement for AnalysisData.add_performance() in worker processes.
+
+    Rows are sent to a PerformanceWriter, which is the only process
+    that writes performance stats to the database.
+    """
+
+    def __init__(self, queue):
+        """Constructor.
+
+        :type queue: multiprocessing.Queue
+        :param queue: Queue shared with PerformanceWriter (e.g., from multiprocessing.Manager).
+        """
+        self.queue = queue
+        return
+
+    def add_performance(self, stats, replace=False):
+        """Send performance stats to writer.
+
+        :type stats: dict
+        :param stats: Performance stats to add to database.
+        """
+        self.queue.put((replace, [stats]))
+        return
+
+    def add_performance_many(self, statsList, replace=False):
+        """Send performance stats for multiple analyses to writer.
+
+        :type statsList: list of dict
+        :param statsList: Performance stats to add to database.
+        """
+        self.queue.put((replace, list(statsList)))
+        return
+
+
+class PerformanceWriter(object):
+    """Single writer of performance stats received over a queue.
+
+    A thread drains the queue and inserts the rows with executemany
+    in large transactions, so worker processes do not contend for the
+    database lock.
+    """
+    BATCH_SIZE = 5000
+
+    def __init__(self, db, queue):
+        """Constructor.
+
+        :type db: AnalysisData
+        :param db: Analysis database.
+
+        :type queue: multiprocessing.Queue
+        :param queue: Queue shared with PerformanceSink objects.
+        """
+        self.db = db
+        self.queue = queue
+        self.numRows = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return
+
+    def sink(self):
+        """Get sink for sending performance stats to this writer from worker processes.
+        """
+        return PerformanceSink(self.queue)
+
+    def close(self):
+        """Write remaining performance stats and stop writer.
+
+        Raises the first error encountered while writing, after the
+        queue has been drained.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        logging.getLogger(__name__).info("Wrote {} performance rows.".format(self.numRows))
+        if self.error is not None:
+            raise self.error
+        return
+
+    def _run(self):
+        """Write batches of performance stats until we get the sentinel.
+        """
+        import queue
+
+        done = False
+        while not done:
+            batch = {False: [], True: []}
+            item = self.queue.get()
+            numRows = 0
+            while True:
+                if item is None:
+                    done = True
+                    break
+                try:
+                    replace, statsList = item
+                    batch[replace] += statsList
+                    numRows += len(statsList)
+                except Exception as ex:
+                    self._error(ex)
+                if numRows >= self.BATCH_SIZE:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            for replace, statsList in batch.items():
+                if len(statsList) == 0:
+                    continue
+                try:
+                    self.db.add_performance_many(statsList, replace)
+                    self.numRows += len(statsList)
+                except Exception as ex:
+                    self._error(ex)
+
+        # Connections are per thread, so the writer thread closes its own.
+        close_connections()
+        return
+
+    def _error(self, ex):
+        """Log error and keep the first one to raise from close().
+
+        We keep draining the queue after an error so workers are not
+        blocked and the remaining rows are still written.
+        """
+        logging.getLogger(__name__).error("Error writing performance stats: {}".format(ex))
+        if self.error is None:
+            self.error = ex
+        return
+
+
 class AnalysisData(object):
     """SQLite database with DM alerts and ComCat events.
     """
+    # Criteria for matching alerts to ComCat events.
+    MATCH_MAX_DISTANCE_DEG = 3.0
+    MATCH_MAX_DISTANCE_KM = 150.0
+    MATCH_MAX_TIME_SECS = 15.0
+    MATCH_VS = 3.0e+3 # m/s, converts origin time difference to distance
 
     def __init__(self, filename):
         """Constructor with filename.
@@ -125,7 +416,7 @@ class AnalysisData(object):
 
         """
         self.filename = filename
-        
+        self.schemaVersion = None
         return
 
     def operation(self):
@@ -135,21 +426,132 @@ class AnalysisData(object):
     def init(self, key):
         """Create database.
         """
+        version = self.schema_version()
+        self._set_journal_mode()
         with self.operation() as op:
             if key == "all":
                 for name, columns in TABLES[::-1]:
-                    op.cursor.execute("DROP TABLE IF EXISTS {}".format(name))
+                    self._drop_table(op, name)
                 for name,columns in TABLES:
                     op.cursor.execute("CREATE TABLE {name} ({fields})".format(name=name, fields=", ".join(columns)))
             else:
                 for name, columns in TABLES:
                     if name == key:
-                        op.cursor.execute("DROP TABLE IF EXISTS {}".format(name))
+                        self._drop_table(op, name)
                         op.cursor.execute("CREATE TABLE {name} ({fields})".format(name=name, fields=", ".join(columns)))
+            if key == "all" or version == SCHEMA_VERSION:
+                for cmd in SCHEMA:
+                    op.cursor.execute(cmd)
+                op.cursor.execute("PRAGMA user_version={:d}".format(SCHEMA_VERSION))
+                self.schemaVersion = SCHEMA_VERSION
+            else:
+                logging.getLogger(__name__).warning("Analysis database has schema version {}; run migrate() to update it to version {}.".format(version, SCHEMA_VERSION))
+        return
+
+    def migrate(self):
+        """Update database created with an earlier schema to the current schema.
+
+        :returns: True if the database was updated, False otherwise.
+        """
+        version = self.schema_version()
+        if version >= SCHEMA_VERSION:
+            return False
+        self._set_journal_mode()
+        with self.operation() as op:
+            if version < 2:
+                self._add_epoch_columns(op)
+            if version < 4:
+                self._add_alert_ids(op)
+            for cmd in SCHEMA_OBSOLETE + SCHEMA:
+                op.cursor.execute(cmd)
+            if version < 4:
+                # R*Tree ids from earlier versions are row ids, which VACUUM may have changed.
+                op.cursor.execute("DELETE FROM eew_alerts_rtree")
+                op.cursor.execute("INSERT INTO eew_alerts_rtree SELECT alert_id, longitude, longitude, latitude, latitude, {ot}, {ot} FROM eew_alerts".format(ot=EPOCH_SQL.format("origin_time")))
+            op.cursor.execute("PRAGMA user_version={:d}".format(SCHEMA_VERSION))
+        logging.getLogger(__name__).info("Migrated analysis database from schema version {} to {}.".format(version, SCHEMA_VERSION))
+        self.schemaVersion = SCHEMA_VERSION
+        return True
+
+    def _set_journal_mode(self):
+        """Set journal mode of database to JOURNAL_MODE.
+        """
+        mode = get_connection(self.filename).execute("PRAGMA journal_mode={}".format(JOURNAL_MODE)).fetchone()[0]
+        if mode.lower() != JOURNAL_MODE.lower():
+            logging.getLogger(__name__).warning("Could not set journal mode of analysis database to {}; using {}.".format(JOURNAL_MODE, mode))
+        return
+
+    def schema_version(self):
+        """Get schema version of database.
+        """
+        if self.schemaVersion is None:
+            # Read the pragma directly so we do not end a transaction
+            # in an operation that is already open.
+            self.schemaVersion = get_connection(self.filename).execute("PRAGMA user_version").fetchone()[0]
+        return self.schemaVersion
+
+    def _add_epoch_columns(self, op):
+        """Add integer timestamp columns and set them from the text columns.
+        """
+        for table, columns in EPOCH_COLUMNS.items():
+            op.cursor.execute("PRAGMA TABLE_INFO({})".format(table))
+            existing = [row[1] for row in op.cursor.fetchall()]
+            for columnUs, column in columns:
+                if not columnUs in existing:
+                    op.cursor.execute("ALTER TABLE {} ADD COLUMN {} INTEGER".format(table, columnUs))
+            textColumns = [column for columnUs, column in columns]
+            op.cursor.execute("SELECT rowid AS rowid, {} FROM {}".format(", ".join(textColumns), table))
+            rows = op.cursor.fetchall()
+            values = [tuple([epoch_us(row[column]) for column in textColumns]) + (row["rowid"],) for row in rows]
+            setColumns = ", ".join(["{}=?".format(columnUs) for columnUs, column in columns])
+            op.cursor.executemany("UPDATE {} SET {} WHERE rowid=?".format(table, setColumns), values)
+            logging.getLogger(__name__).info("Set integer timestamps for {} rows in {}.".format(len(values), table))
+        return
+
+    def _add_alert_ids(self, op):
+        """Rebuild eew_alerts table with alert_id column holding the current row ids.
+
+        Row ids without an INTEGER PRIMARY KEY column may change
+        (for example, VACUUM renumbers them), so they cannot be used
+        to refer to alerts. SQLite cannot add a primary key column, so
+        we copy the alerts into a new table. Dropping the old table
+        drops its indices and triggers; migrate() recreates them.
+        """
+        op.cursor.execute("PRAGMA TABLE_INFO(eew_alerts)")
+        existing = [row[1] for row in op.cursor.fetchall()]
+        if "alert_id" in existing:
+            return
+        columns = dict(TABLES)["eew_alerts"]
+        names = ", ".join([column.split()[0] for column in columns if not column.startswith("UNIQUE") and column.split()[0] != "alert_id"])
+        op.cursor.execute("DROP TABLE IF EXISTS event_alert_matches")
+        op.cursor.execute("CREATE TABLE eew_alerts_ids ({})".format(", ".join(columns)))
+        op.cursor.execute("INSERT INTO eew_alerts_ids(alert_id, {names}) SELECT rowid, {names} FROM eew_alerts".format(names=names))
+        op.cursor.execute("DROP TABLE eew_alerts")
+        op.cursor.execute("ALTER TABLE eew_alerts_ids RENAME TO eew_alerts")
+        logging.getLogger(__name__).info("Added alert ids to {} alerts.".format(op.cursor.execute("SELECT COUNT(*) FROM eew_alerts").fetchone()[0]))
+        return
+
+    def _drop_table(self, op, name):
+        """Drop table and tables derived from it.
+        """
+        for derived in DERIVED_TABLES.get(name, []):
+            op.cursor.execute("DROP TABLE IF EXISTS {}".format(derived))
+        op.cursor.execute("DROP TABLE IF EXISTS {}".format(name))
         return
 
     def add_alerts(self, alerts, replace=False):
-        """Add alert info to database.
+        """Add alert info to database in a single transaction.
+
+        Alerts already in the database are skipped (replace=False) or
+        replaced (replace=True).
+
+        :type alerts: list of dict
+        :param alerts: Alerts to add to database.
+
+        :type replace: bool
+        :param replace: If True, replace existing alerts.
+
+        :returns: Tuple of number of alerts inserted and number of alerts already in database.
         """
         COLUMNS = (
             "server",
@@ -166,21 +568,29 @@ class AnalysisData(object):
             "origin_time",
             "num_stations",
             )
+        if self.schema_version() >= 2:
+            COLUMNS += ("timestamp_us", "origin_time_us",)
+            alerts = [dict(alert, timestamp_us=epoch_us(alert["timestamp"]), origin_time_us=epoch_us(alert["origin_time"])) for alert in alerts]
         insertCols = ", ".join(COLUMNS)
         valueCols = ", ".join([":{}".format(col) for col in COLUMNS])
-        cmd = "INSERT"
-        if replace:
-            cmd += " OR REPLACE"
         with self.operation() as op:
-            try:
-                #self.cursor.executemany("INSERT INTO eew_alerts({}) VALUES({})".format(insertCols, valueCols), alerts)
-                for alert in alerts:
-                    op.cursor.execute("{} INTO eew_alerts({}) VALUES({})".format(cmd, insertCols, valueCols), alert)
-            except sqlite3.IntegrityError as ex:
-                logging.getLogger(__name__).debug(str(ex))
-                #logging.getLogger(__name__).debug(str(alerts))
-                logging.getLogger(__name__).debug(str(alert))
-        return
+            if replace:
+                # Update existing alerts in place so they keep their row
+                # ids. New rows get row ids larger than any existing one.
+                op.cursor.execute("SELECT COALESCE(MAX(rowid), 0) FROM eew_alerts")
+                maxRowid = op.cursor.fetchone()[0]
+                updateCols = ", ".join(["{0}=excluded.{0}".format(col) for col in COLUMNS if not col in ALERTS_KEY])
+                cmd = "INSERT INTO eew_alerts({}) VALUES({}) ON CONFLICT({}) DO UPDATE SET {}".format(insertCols, valueCols, ", ".join(ALERTS_KEY), updateCols)
+                op.cursor.executemany(cmd, alerts)
+                op.cursor.execute("SELECT COUNT(*) FROM eew_alerts WHERE rowid > ?", (maxRowid,))
+                numInserted = op.cursor.fetchone()[0]
+            else:
+                op.cursor.executemany("INSERT OR IGNORE INTO eew_alerts({}) VALUES({})".format(insertCols, valueCols), alerts)
+                numInserted = max(0, op.cursor.rowcount)
+            numDuplicates = len(alerts) - numInserted
+        if numDuplicates > 0:
+            logging.getLogger(__name__).debug("{} {} alerts already in database.".format("Replaced" if replace else "Skipped", numDuplicates))
+        return (numInserted, numDuplicates)
     
     def add_event(self, event, replace=False):
         """Add ComCat event to database.
@@ -200,8 +610,11 @@ class AnalysisData(object):
             )
 
         originTime = event.time if event.time.tzinfo else event.time.replace(tzinfo=pytz.UTC)
-        insertCols = ", ".join(COLUMNS)
         eventValues = (event.id, event.latitude, event.longitude, event.depth, originTime, event.magnitude, event["magType"], event.location)
+        if self.schema_version() >= 2:
+            COLUMNS += ("origin_time_us",)
+            eventValues += (epoch_us(originTime),)
+        insertCols = ", ".join(COLUMNS)
         valueCols = ",".join("?"*len(eventValues))
         cmd = "INSERT"
         if replace:
@@ -292,6 +705,15 @@ class AnalysisData(object):
         :type stats: dict
         :param stats: Performance stats to add to database.
         """
+        self.add_performance_many([stats], replace)
+        return
+
+    def add_performance_many(self, statsList, replace=False):
+        """Add performance stats for multiple analyses to database in a single transaction.
+
+        :type statsList: list of dict
+        :param statsList: Performance stats to add to database.
+        """
         COLUMNS = (
             "comcat_id",
             "eew_server",
@@ -313,22 +735,21 @@ class AnalysisData(object):
             "population_costsavings_eew",
             "population_costsavings_perfecteew",
             )
-        NTRIES = 50
         
         insertCols = ", ".join(COLUMNS)
-        perfValues = [stats[col] for col in COLUMNS]
-        perfCols = ",".join("?"*len(perfValues))
+        perfValues = [[stats[col] for col in COLUMNS] for stats in statsList]
+        perfCols = ",".join("?"*len(COLUMNS))
         cmd = "INSERT"
         if replace:
             cmd += " OR REPLACE"
 
         with self.operation() as op:
             try:
-                op.cursor.execute("{0} INTO performance({1}) VALUES({2})".format(cmd, insertCols, perfCols), perfValues)
+                op.cursor.executemany("{0} INTO performance({1}) VALUES({2})".format(cmd, insertCols, perfCols), perfValues)
             
             except sqlite3.IntegrityError as ex:
                 logging.getLogger(__name__).debug(str(ex))
-                logging.getLogger(__name__).debug(str(stats))
+                logging.getLogger(__name__).debug(str(statsList))
 
         return
 
@@ -337,11 +758,13 @@ class AnalysisData(object):
         """
         from . import greatcircle
         
-        MAX_DISTANCE_DEG = 3.0
-        MAX_DISTANCE_KM = 150.0
-        MAX_TIME_SECS = 15.0
-        VS = 3.0e+3
+        MAX_DISTANCE_DEG = self.MATCH_MAX_DISTANCE_DEG
+        MAX_DISTANCE_KM = self.MATCH_MAX_DISTANCE_KM
+        MAX_TIME_SECS = self.MATCH_MAX_TIME_SECS
+        VS = self.MATCH_VS
 
+        # Alerts do not have stable ids before schema version 4.
+        alertId = "alert_id" if self.schema_version() >= 4 else "rowid"
         with self.operation() as op:
             op.cursor.execute("SELECT * FROM comcat_events WHERE event_id=?", (comcatId,))
             event = op.cursor.fetchone()
@@ -349,22 +772,46 @@ class AnalysisData(object):
             lat = event["latitude"]
             lon = event["longitude"]
             ot = dateutil.parser.parse(event["origin_time"])
+            otEpoch = (ot if ot.tzinfo else ot.replace(tzinfo=pytz.UTC)).timestamp()
             dt = datetime.timedelta(seconds=MAX_TIME_SECS)
             conditions = [
                 "category=?",
                 "message_type=?",
                 "latitude BETWEEN ? AND ?",
                 "longitude BETWEEN ? AND ?",
-                "origin_time BETWEEN ? AND ?",
             ]
             values = (
                 "live",
                 "new",
                 lat-MAX_DISTANCE_DEG, lat+MAX_DISTANCE_DEG,
                 lon-MAX_DISTANCE_DEG, lon+MAX_DISTANCE_DEG,
-                ot-dt, ot+dt,
             )
-            op.cursor.execute("SELECT * FROM eew_alerts WHERE " + " AND ".join(conditions), values)
+            if self.schema_version() >= 2:
+                otUs = epoch_us(ot)
+                dtUs = int(MAX_TIME_SECS*1.0e+6)
+                conditions.append("origin_time_us BETWEEN ? AND ?")
+                values += (otUs-dtUs, otUs+dtUs)
+                columns = "eew_alerts.*, eew_alerts.{} AS match_id, 1.0e-6*eew_alerts.origin_time_us AS origin_epoch".format(alertId)
+            else:
+                conditions.append("origin_time BETWEEN ? AND ?")
+                values += (ot-dt, ot+dt)
+                columns = "eew_alerts.*, eew_alerts.{} AS match_id, {} AS origin_epoch".format(alertId, EPOCH_SQL.format("eew_alerts.origin_time"))
+            if self.schema_version() >= 1:
+                # Prefilter candidates with R*Tree index.
+                rtreeConditions = [
+                    "eew_alerts_rtree.min_lon <= ? AND eew_alerts_rtree.max_lon >= ?",
+                    "eew_alerts_rtree.min_lat <= ? AND eew_alerts_rtree.max_lat >= ?",
+                    "eew_alerts_rtree.min_ot <= ? AND eew_alerts_rtree.max_ot >= ?",
+                ]
+                rtreeValues = (
+                    lon+MAX_DISTANCE_DEG, lon-MAX_DISTANCE_DEG,
+                    lat+MAX_DISTANCE_DEG, lat-MAX_DISTANCE_DEG,
+                    otEpoch+MAX_TIME_SECS, otEpoch-MAX_TIME_SECS,
+                )
+                cmd = "SELECT {} FROM eew_alerts_rtree JOIN eew_alerts ON eew_alerts.{}=eew_alerts_rtree.id WHERE ".format(columns, alertId)
+                op.cursor.execute(cmd + " AND ".join(rtreeConditions + ["eew_alerts."+c for c in conditions]), rtreeValues + values)
+            else:
+                op.cursor.execute("SELECT {} FROM eew_alerts WHERE ".format(columns) + " AND ".join(conditions), values)
             alerts = op.cursor.fetchall()
         if 0 == len(alerts):
             return None
@@ -381,30 +828,266 @@ class AnalysisData(object):
             dist = greatcircle.distance(lon, lat, alert["longitude"], alert["latitude"])
             if dist*1e-3 > MAX_DISTANCE_KM:
                 continue
-            distOT = abs((dateutil.parser.parse(alert["origin_time"])-ot).total_seconds())*VS
+            distOT = abs(alert["origin_epoch"]-otEpoch)*VS
             if dist + distOT < minDist:
                 alertMatch = alert
-                minDist = dist
+                minDist = dist + distOT
         return alertMatch
 
+    def find_matches(self, comcatIds, server):
+        """Find initial alerts matching ComCat events.
+
+        Same criteria as find_match() applied to all events at once:
+        we load the candidate alerts sorted by origin time, find the
+        alerts within the origin time window of each event with a
+        binary search, and score all event-alert pairs with
+        vectorized great circle distances.
+
+        :type comcatIds: list of str
+        :param comcatIds: ComCat event ids.
+
+        :type server: str
+        :param server: Name of EEW server.
+
+        :returns: Dictionary of ComCat event id and id of matching alert (None if no match).
+        """
+        from . import greatcircle
+
+        if self.schema_version() < 2:
+            matches = {}
+            for comcatId in comcatIds:
+                alert = self.find_match(comcatId, server)
+                matches[comcatId] = alert["match_id"] if alert else None
+            return matches
+
+        alertId = "alert_id" if self.schema_version() >= 4 else "rowid"
+
+        dtUs = int(self.MATCH_MAX_TIME_SECS*1.0e+6)
+        with self.operation() as op:
+            self._fill_batch_events(op, comcatIds)
+            op.cursor.execute("SELECT e.event_id, e.longitude, e.latitude, e.origin_time_us FROM temp.batch_events AS b JOIN comcat_events AS e ON e.event_id=b.event_id ORDER BY b.position")
+            events = op.cursor.fetchall()
+            op.cursor.execute("DELETE FROM temp.batch_events")
+            if len(events) == 0:
+                return {comcatId: None for comcatId in comcatIds}
+            eventOT = numpy.array([event["origin_time_us"] for event in events], dtype=numpy.int64)
+
+            conditions = [
+                "category=?",
+                "message_type=?",
+                "origin_time_us BETWEEN ? AND ?",
+                "server IN (?,?,?)",
+            ]
+            values = ("live", "new", int(numpy.min(eventOT))-dtUs, int(numpy.max(eventOT))+dtUs, "unknown", "eew2", server)
+            op.cursor.execute("SELECT {0}, longitude, latitude, origin_time_us FROM eew_alerts WHERE ".format(alertId) + " AND ".join(conditions) + " ORDER BY origin_time_us,{0}".format(alertId), values)
+            alerts = op.cursor.fetchall()
+
+        matches = {comcatId: None for comcatId in comcatIds}
+        if len(alerts) == 0:
+            return matches
+        eventLon = numpy.array([event["longitude"] for event in events], dtype=numpy.float64)
+        eventLat = numpy.array([event["latitude"] for event in events], dtype=numpy.float64)
+        alertIds = numpy.array([alert[0] for alert in alerts], dtype=numpy.int64)
+        alertLon = numpy.array([alert[1] for alert in alerts], dtype=numpy.float64)
+        alertLat = numpy.array([alert[2] for alert in alerts], dtype=numpy.float64)
+        alertOT = numpy.array([alert[3] for alert in alerts], dtype=numpy.int64)
+
+        # Event-alert pairs within origin time window.
+        lo = numpy.searchsorted(alertOT, eventOT-dtUs, side="left")
+        hi = numpy.searchsorted(alertOT, eventOT+dtUs, side="right")
+        counts = hi - lo
+        iEvent = numpy.repeat(numpy.arange(eventOT.shape[0]), counts)
+        iAlert = numpy.repeat(lo, counts) + numpy.arange(iEvent.shape[0]) - numpy.repeat(numpy.cumsum(counts)-counts, counts)
+
+        mask = numpy.logical_and(numpy.abs(alertLat[iAlert]-eventLat[iEvent]) <= self.MATCH_MAX_DISTANCE_DEG,
+                                 numpy.abs(alertLon[iAlert]-eventLon[iEvent]) <= self.MATCH_MAX_DISTANCE_DEG)
+        iEvent = iEvent[mask]
+        iAlert = iAlert[mask]
+        dist = greatcircle.distance(eventLon[iEvent], eventLat[iEvent], alertLon[iAlert], alertLat[iAlert])
+        mask = dist*1.0e-3 <= self.MATCH_MAX_DISTANCE_KM
+        iEvent = iEvent[mask]
+        iAlert = iAlert[mask]
+        score = dist[mask] + 1.0e-6*numpy.abs(alertOT[iAlert]-eventOT[iEvent])*self.MATCH_VS
+
+        # Best scoring alert for each event.
+        order = numpy.lexsort((score, iEvent))
+        iEvent = iEvent[order]
+        first = numpy.ones(iEvent.shape, dtype=bool)
+        first[1:] = iEvent[1:] != iEvent[:-1]
+        for ievent, ialert in zip(iEvent[first], iAlert[order][first]):
+            matches[events[ievent]["event_id"]] = int(alertIds[ialert])
+        return matches
+
     def alerts(self, comcatId, server):
         """Get ShakeAlert alerts for event matching ComCat id.
 
+        Matches are read from the event_alert_matches table (see
+        match_events()); events not in the table are matched without
+        storing the match, so reading alerts never writes to the
+        database.
+
         :type comcatId: str
         :param comcatId: ComCat event id.
         """
-        alert = self.find_match(comcatId, server)
-        if alert is None:
-            return []
-        
+        if self.schema_version() < SCHEMA_VERSION:
+            alert = self.find_match(comcatId, server)
+            if alert is None:
+                return []
+            (conditions, values, order) = self._alerts_query(alert)
+            with self.operation() as op:
+                op.cursor.execute("SELECT * FROM eew_alerts WHERE " + " AND ".join(conditions) + " ORDER BY " + order, values)
+                alerts = op.cursor.fetchall()
+            return alerts
+
+        return self._matched_alerts(comcatId, server, "eew_alerts.*")
+
+    def alerts_array(self, comcatId, server):
+        """Get ShakeAlert alerts for event matching ComCat id as a Numpy structured array.
+
+        Timestamps and origin times are datetime64[us] (UTC) read
+        directly from the integer timestamp columns, so they are not
+        parsed from text. Requires the current schema version (see migrate()).
+
+        :type comcatId: str
+        :param comcatId: ComCat event id.
+        """
+        COLUMNS = (
+            ("event_id", "int64"),
+            ("version", "int32"),
+            ("timestamp_us", "datetime64[us]"),
+            ("origin_time_us", "datetime64[us]"),
+            ("magnitude", "float32"),
+            ("latitude", "float64"),
+            ("longitude", "float64"),
+            ("depth_km", "float32"),
+            ("num_stations", "int32"),
+        )
+        if self.schema_version() < SCHEMA_VERSION:
+            raise ValueError("Analysis database schema version {} is older than version {}. Run migrate().".format(self.schema_version(), SCHEMA_VERSION))
+        dtype = [(name.replace("_us", ""), fmt) for name, fmt in COLUMNS]
+        columns = ", ".join(["eew_alerts."+name for name, fmt in COLUMNS])
+        rows = self._matched_alerts(comcatId, server, columns)
+        return numpy.array([tuple([row[name] for name, fmt in COLUMNS]) for row in rows], dtype=dtype)
+
+    def match_events(self, server, comcatIds=None):
+        """Match alerts to ComCat events and store matches in event_alert_matches table.
+
+        Changes to eew_alerts remove all stored matches and changes
+        to comcat_events remove the matches for the changed events.
+
+        :type server: str
+        :param server: Name of EEW server.
+
+        :type comcatIds: list of str
+        :param comcatIds: ComCat event ids (None for all events).
+
+        :returns: Dictionary of ComCat event id and list of ids of matching alerts.
+        """
+        if self.schema_version() < SCHEMA_VERSION:
+            raise ValueError("Analysis database schema version {} is older than version {}. Run migrate().".format(self.schema_version(), SCHEMA_VERSION))
+        if comcatIds is None:
+            with self.operation() as op:
+                op.cursor.execute("SELECT event_id FROM comcat_events ORDER BY event_id")
+                comcatIds = [row[0] for row in op.cursor.fetchall()]
+
+        matches = self._compute_matches(comcatIds, server)
+
+        rows = []
+        for comcatId, alertIds in matches.items():
+            if len(alertIds) > 0:
+                rows += [(comcatId, server, position, alertId) for position, alertId in enumerate(alertIds)]
+            else:
+                rows.append((comcatId, server, -1, None))
+        with self.operation() as op:
+            op.cursor.executemany("DELETE FROM event_alert_matches WHERE comcat_id=? AND eew_server=?", [(comcatId, server) for comcatId in matches])
+            op.cursor.executemany("INSERT INTO event_alert_matches(comcat_id, eew_server, position, alert_id) VALUES(?,?,?,?)", rows)
+        return matches
+
+    def _compute_matches(self, comcatIds, server):
+        """Find alerts matching ComCat events.
+
+        :type comcatIds: list of str
+        :param comcatIds: ComCat event ids.
+
+        :type server: str
+        :param server: Name of EEW server.
+
+        :returns: Dictionary of ComCat event id and list of ids of matching alerts.
+        """
+        initial = self.find_matches(comcatIds, server)
+        matches = {comcatId: [] for comcatId in comcatIds}
+        matched = [(comcatId, alertId) for comcatId, alertId in initial.items() if alertId is not None]
+        if len(matched) == 0:
+            return matches
+
+        # Subsequent alerts matching id and instance within 10 min of initial alert.
+        WINDOW_US = int(600*1.0e+6)
+        with self.operation() as op:
+            op.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS batch_matches (position INTEGER PRIMARY KEY, alert_id INTEGER NOT NULL)")
+            op.cursor.execute("DELETE FROM temp.batch_matches")
+            op.cursor.executemany("INSERT INTO temp.batch_matches(position, alert_id) VALUES(?,?)", [(i, alertId) for i, (comcatId, alertId) in enumerate(matched)])
+            cmd = "SELECT m.position, a.alert_id FROM temp.batch_matches AS m" \
+                " JOIN eew_alerts AS i ON i.alert_id=m.alert_id" \
+                " JOIN eew_alerts AS a ON a.event_id=i.event_id AND a.server=i.server AND a.category=?" \
+                " AND (a.message_type=? OR a.message_type=?) AND a.timestamp_us BETWEEN i.timestamp_us AND i.timestamp_us+?" \
+                " ORDER BY m.position,a.timestamp_us,a.version"
+            op.cursor.execute(cmd, ("live", "new", "update", WINDOW_US))
+            rows = op.cursor.fetchall()
+            op.cursor.execute("DELETE FROM temp.batch_matches")
+        for position, alertId in rows:
+            matches[matched[position][0]].append(alertId)
+        return matches
+
+    def _matched_alerts(self, comcatId, server, columns):
+        """Get alerts matching ComCat event.
+
+        We read the stored match and the alerts with a single query, so
+        a concurrent change to the alerts (which clears the stored
+        matches) cannot leave us with a partial result. If the match is
+        not stored, we compute it without storing it.
+
+        :type comcatId: str
+        :param comcatId: ComCat event id.
+
+        :type server: str
+        :param server: Name of EEW server.
+
+        :type columns: str
+        :param columns: Columns of eew_alerts to get.
+
+        :returns: List of rows with alerts.
+        """
+        with self.operation() as op:
+            cmd = "SELECT m.position AS match_position, eew_alerts.alert_id AS match_id, " + columns + \
+                " FROM event_alert_matches AS m LEFT JOIN eew_alerts ON eew_alerts.alert_id=m.alert_id" \
+                " WHERE m.comcat_id=? AND m.eew_server=? ORDER BY m.position"
+            op.cursor.execute(cmd, (comcatId, server))
+            rows = op.cursor.fetchall()
+        if len(rows) > 0 and all([row["match_position"] < 0 or row["match_id"] is not None for row in rows]):
+            return [row for row in rows if row["match_position"] >= 0]
+
+        alertIds = self._compute_matches([comcatId], server)[comcatId]
+        alerts = []
+        with self.operation() as op:
+            for alertId in alertIds:
+                op.cursor.execute("SELECT 0 AS match_position, alert_id AS match_id, " + columns + " FROM eew_alerts WHERE alert_id=?", (alertId,))
+                alerts += op.cursor.fetchall()
+        return alerts
+
+    def _alerts_query(self, alert):
+        """Get conditions, values, and order for query of alerts following matching alert.
+
+        :type alert: sqlite3.Row
+        :param alert: Alert matching ComCat event.
+
+        :returns: Tuple of conditions, values, and order.
+        """
         # Get subsequent alerts matching id  and instance within 10 min
-        timestamp = dateutil.parser.parse(alert["timestamp"])
         conditions = [
             "category=?",
             "(message_type=? OR message_type=?)",
             "event_id=?",
             "server=?",
-            "timestamp BETWEEN ? AND ?",
             ]
         values = (
             "live",
@@ -412,15 +1095,30 @@ class AnalysisData(object):
             "update",
             alert["event_id"],
             alert["server"],
-            timestamp, timestamp+datetime.timedelta(minutes=10.0),
             )
-        with self.operation() as op:
-            op.cursor.execute("SELECT * FROM eew_alerts WHERE " + " AND ".join(conditions), values)
-            alerts = op.cursor.fetchall()
-        return alerts
+        if self.schema_version() >= 2:
+            timestamp = alert["timestamp_us"]
+            conditions.append("timestamp_us BETWEEN ? AND ?")
+            values += (timestamp, timestamp+int(600*1.0e+6))
+            order = "timestamp_us,version"
+        else:
+            timestamp = dateutil.parser.parse(alert["timestamp"])
+            conditions.append("timestamp BETWEEN ? AND ?")
+            values += (timestamp, timestamp+datetime.timedelta(minutes=10.0))
+            order = "timestamp,version"
+        return (conditions, values, order)
 
     def performance_stats(self, comcatId, server, gmpe, fragility, alertLatencySec, magnitudeThreshold=None, mmiThreshold=None):
-        """
+        """Get performance stats for event.
+
+        Alert latency and thresholds are matched with the same
+        tolerance as numpy.isclose(). Magnitude and MMI thresholds
+        that are None (or zero) select all thresholds.
+
+        :type comcatId: str
+        :param comcatId: ComCat event id.
+
+        :returns: Numpy structured array with performance stats ordered by magnitude and MMI thresholds.
         """
         conditions = [
             "comcat_id=?",
@@ -434,47 +1132,113 @@ class AnalysisData(object):
             gmpe,
             fragility,
             )
+        for column, value in (("alert_latency_sec", alertLatencySec), ("magnitude_threshold", magnitudeThreshold), ("mmi_threshold", mmiThreshold)):
+            if column != "alert_latency_sec" and not value:
+                continue
+            conditions.append(self._isclose_condition(column))
+            values += (value, value)
         with self.operation() as op:
+            dtype = self._table_dtype(op, "performance")
             op.cursor.execute("SELECT * FROM performance WHERE " + " AND ".join(conditions) + " ORDER BY magnitude_threshold,mmi_threshold", values)
-            # :TODO: :KLUDGE: to get structured array
-            # Can we use PRAGMA TABLE_INFO to get column name and type (to map to numpy.dtype)?
-            dtype = [
-                ("comcat_id", "|S32"),
-                ("eew_server", "|S32"),
-                ("dm_id", "int32"),
-                ("dm_timestamp", "|S32"),
-                ("gmpe", "|S32"),
-                ("fragility", "|S32"),
-                ("magnitude_threshold", "float32"),
-                ("mmi_threshold", "float32"),
-                ("alert_latency_sec", "float32"),
-                ("area_damage", "float32"),
-                ("area_alert", "float32"),
-                ("area_alert_perfect", "float32"),
-                ("area_costsavings_eew", "float32"),
-                ("area_costsavings_perfecteew", "float32"),
-                ("population_damage", "float32"),
-                ("population_alert", "float32"),
-                ("population_alert_perfect", "float32"),
-                ("population_costsavings_eew", "float32"),
-                ("population_costsavings_perfecteew", "float32"),
+            results = op.cursor.fetchall()
+        return numpy.array([tuple(result) for result in results], dtype=dtype)
+
+    def performance_stats_events(self, comcatIds, server, gmpe, fragility, alertLatencySec, magnitudeThreshold=None, mmiThreshold=None):
+        """Get performance stats for multiple events joined with event information in a single query.
+
+        Same selection as performance_stats() applied to each event,
+        with rows ordered by event (in the order of comcatIds) and
+        then by magnitude and MMI thresholds. Fields
+        'event_magnitude', 'event_longitude', 'event_latitude',
+        'event_depth_km', 'event_origin_time' (datetime64[us], UTC),
+        and 'event_description' hold the ComCat event information.
+
+        :type comcatIds: list of str
+        :param comcatIds: ComCat event ids.
+
+        :returns: Numpy structured array with performance stats and event information.
+        """
+        EVENT_COLUMNS = (
+            ("magnitude", "float64"),
+            ("longitude", "float64"),
+            ("latitude", "float64"),
+            ("depth_km", "float64"),
+            ("description", "U128"),
+        )
+        conditions = [
+            "p.eew_server=?",
+            "p.gmpe=?",
+            "p.fragility=?",
             ]
+        values = (
+            server,
+            gmpe,
+            fragility,
+            )
+        for column, value in (("alert_latency_sec", alertLatencySec), ("magnitude_threshold", magnitudeThreshold), ("mmi_threshold", mmiThreshold)):
+            if column != "alert_latency_sec" and not value:
+                continue
+            conditions.append(self._isclose_condition("p."+column))
+            values += (value, value)
+        originTime = "e.origin_time_us" if self.schema_version() >= 2 else "e.origin_time"
+        columns = ["p.*"] + ["e.{0} AS event_{0}".format(name) for name, fmt in EVENT_COLUMNS] + [originTime + " AS event_origin_time"]
+        with self.operation() as op:
+            dtype = self._table_dtype(op, "performance")
+            self._fill_batch_events(op, comcatIds)
+            cmd = "SELECT " + ", ".join(columns) + " FROM temp.batch_events AS b" \
+                " JOIN performance AS p ON p.comcat_id=b.event_id" \
+                " LEFT JOIN comcat_events AS e ON e.event_id=b.event_id" \
+                " WHERE " + " AND ".join(conditions) + \
+                " ORDER BY b.position,p.magnitude_threshold,p.mmi_threshold"
+            op.cursor.execute(cmd, values)
             results = op.cursor.fetchall()
-            
-        nrows = len(results)
-        stats = numpy.zeros(nrows, dtype=dtype)
-        for iresult, result in enumerate(results):
-            stats[iresult] = tuple([result[key] for key in result.keys()])
-
-        mask = numpy.ma.masked_values(stats["alert_latency_sec"], alertLatencySec).mask
-        stats = stats[mask]
-        if magnitudeThreshold:
-            mask = numpy.ma.masked_values(stats["magnitude_threshold"], magnitudeThreshold).mask
-            stats = stats[mask]
-        if mmiThreshold:
-            mask = numpy.ma.masked_values(stats["mmi_threshold"], mmiThreshold).mask
-            stats = stats[mask]
-        return stats
+            op.cursor.execute("DELETE FROM temp.batch_events")
+
+        dtype += [("event_"+name, fmt) for name, fmt in EVENT_COLUMNS] + [("event_origin_time", "datetime64[us]")]
+        if self.schema_version() >= 2:
+            rows = [tuple(result) for result in results]
+        else:
+            rows = [tuple(result)[:-1] + (epoch_us(result["event_origin_time"]) if result["event_origin_time"] else None,) for result in results]
+        return numpy.array(rows, dtype=dtype)
+
+    def _fill_batch_events(self, op, comcatIds):
+        """Fill temporary table batch_events with ComCat event ids and their positions.
+
+        :type op: Operation
+        :param op: Database operation.
+
+        :type comcatIds: list of str
+        :param comcatIds: ComCat event ids.
+        """
+        op.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS batch_events (position INTEGER PRIMARY KEY, event_id TEXT NOT NULL)")
+        op.cursor.execute("DELETE FROM temp.batch_events")
+        op.cursor.executemany("INSERT INTO temp.batch_events(position, event_id) VALUES(?,?)", enumerate(comcatIds))
+        return
+
+    @staticmethod
+    def _isclose_condition(column, rtol=1.0e-5, atol=1.0e-8):
+        """Get SQL condition for column equal to value within tolerance (same as numpy.isclose()).
+
+        The condition has two parameters, both set to the value.
+        """
+        return "ABS({col}-?) <= {atol} + {rtol}*ABS(?)".format(col=column, atol=atol, rtol=rtol)
+
+    def _table_dtype(self, op, table):
+        """Get Numpy dtype for rows of table from column types.
+
+        :type op: Operation
+        :param op: Database operation.
+
+        :type table: str
+        :param table: Name of table.
+        """
+        TYPES = {
+            "TEXT": "|S32",
+            "INTEGER": "int32",
+            "REAL": "float32",
+        }
+        op.cursor.execute("PRAGMA TABLE_INFO({})".format(table))
+        return [(column["name"], TYPES[column["type"].upper()]) for column in op.cursor.fetchall()]
     
     def most_recent_alert(self, server):
         """Get most recent alert in database.
@@ -484,8 +1248,9 @@ class AnalysisData(object):
 
         :returns: Most recent alert for server in database.
         """
+        order = "timestamp_us" if self.schema_version() >= 2 else "date(timestamp)"
         with self.operation() as op:
-            op.cursor.execute("SELECT * from eew_alerts ORDER BY date(timestamp) DESC LIMIT 1")
+            op.cursor.execute("SELECT * from eew_alerts ORDER BY {} DESC LIMIT 1".format(order))
             alert = op.cursor.fetchone()
         return alert
     
@@ -529,39 +1294,72 @@ class AnalysisData(object):
                 sout += "  Number of rows: {}\n".format(nrows)
         return sout
 
-    def summary(self):
-        """Returns string with database summary.
+    def summary(self, fout=None, groupBy=None):
+        """Write summary of database contents.
+
+        Rows are joined with their ComCat events in SQL and written as
+        they are read, so large tables are not held in memory.
+
+        :type fout: file object
+        :param fout: File object for output. If None, return summary as a string.
+
+        :type groupBy: str
+        :param groupBy: If "event", summarize performance data for each
+            event (number of rows and maximum cost savings for each GMPE and
+            fragility) rather than writing every row.
         """
-        sout = ""
+        if fout is None:
+            import io
+            sout = io.StringIO()
+            self.summary(sout, groupBy)
+            return sout.getvalue()
+
+        def eventMagnitude(row):
+            if row["event_magnitude"] is None:
+                return "  ?    "
+            return "{:3s}{:.2f}".format(row["event_magnitude_type"] or "", row["event_magnitude"])
 
         with self.operation() as op:
         
             # Comcat events
-            sout += "\nComCat Events\n"
-            op.cursor.execute("SELECT * FROM comcat_events ORDER BY origin_time")
-            rows = op.cursor.fetchall()
-            for row in rows:
-                ot = dateutil.parser.parse(row["origin_time"])
-                sout += "{row[event_id]} {row[longitude]:9.4f} {row[latitude]:8.4f} {row[depth_km]:4.1f} {ot:%Y-%m-%dT%H:%M} {row[magnitude_type]:3s}{row[magnitude]:.2f} {row[description]}\n".format(row=row, ot=ot)
+            fout.write("\nComCat Events\n")
+            op.cursor.execute("SELECT *, strftime('%Y-%m-%dT%H:%M', origin_time) AS ot FROM comcat_events ORDER BY origin_time")
+            for row in op.cursor:
+                fout.write("{row[event_id]} {row[longitude]:9.4f} {row[latitude]:8.4f} {row[depth_km]:4.1f} {row[ot]} {row[magnitude_type]:3s}{row[magnitude]:.2f} {row[description]}\n".format(row=row))
     
             # Comcat Shakemap
-            sout += "\nShakeMap Info\n"
-            op.cursor.execute("SELECT * FROM comcat_shakemaps ORDER BY event_id")
-            rows = op.cursor.fetchall()
-            for row in rows:
-                event = self.comcat_event(row["event_id"])
-                sout += "{row[event_id]} {event[magnitude_type]:3s}{event[magnitude]:.2f} {row[mmi_max]:3.1f} {row[pga_max]:6.2f}%g {row[pgv_max]:5.1f}cm/s {row[mmi_bias]:5.2f} {row[pga_bias]:5.2f} {row[pgv_bias]:5.2f} {row[gmpe]} {row[pgm2mi]} v{row[software_version]} {event[description]}\n".format(row=row, event=event)
+            fout.write("\nShakeMap Info\n")
+            op.cursor.execute(
+                "SELECT comcat_shakemaps.*, comcat_events.magnitude AS event_magnitude, comcat_events.magnitude_type AS event_magnitude_type, comcat_events.description AS event_description "
+                "FROM comcat_shakemaps LEFT JOIN comcat_events ON comcat_events.event_id=comcat_shakemaps.event_id "
+                "ORDER BY comcat_shakemaps.event_id")
+            for row in op.cursor:
+                fout.write("{row[event_id]} {mag} {row[mmi_max]:3.1f} {row[pga_max]:6.2f}%g {row[pgv_max]:5.1f}cm/s {row[mmi_bias]:5.2f} {row[pga_bias]:5.2f} {row[pgv_bias]:5.2f} {row[gmpe]} {row[pgm2mi]} v{row[software_version]} {row[event_description]}\n".format(row=row, mag=eventMagnitude(row)))
                 
             # Alerts
     
             # Performance
-            sout += "\nPerformance Data\n"
-            op.cursor.execute("SELECT * FROM performance ORDER BY comcat_id,fragility,gmpe,magnitude_threshold,mmi_threshold,alert_latency_sec")
-            rows = op.cursor.fetchall()
-            for row in rows:
-                event = self.comcat_event(row["comcat_id"])
-                sout += "{row[comcat_id]} {event[magnitude_type]:3s}{event[magnitude]:.2f} {row[gmpe]} {row[fragility]} {row[magnitude_threshold]:3.1f} {row[mmi_threshold]:3.1f} {row[alert_latency_sec]:3.1f} {row[area_costsavings_eew]:6.2f} {row[area_costsavings_perfecteew]:6.2f} {row[population_costsavings_eew]:6.2f} {row[population_costsavings_perfecteew]:6.2f} {event[description]}\n".format(row=row, event=event)
-        return sout
+            fout.write("\nPerformance Data\n")
+            eventColumns = "comcat_events.magnitude AS event_magnitude, comcat_events.magnitude_type AS event_magnitude_type, comcat_events.description AS event_description"
+            if groupBy == "event":
+                op.cursor.execute(
+                    "SELECT perf.*, " + eventColumns + " FROM "
+                    "(SELECT comcat_id, gmpe, fragility, COUNT(*) AS num_rows, "
+                    "MAX(area_costsavings_eew) AS area_costsavings_eew, MAX(area_costsavings_perfecteew) AS area_costsavings_perfecteew, "
+                    "MAX(population_costsavings_eew) AS population_costsavings_eew, MAX(population_costsavings_perfecteew) AS population_costsavings_perfecteew "
+                    "FROM performance GROUP BY comcat_id, gmpe, fragility) AS perf "
+                    "LEFT JOIN comcat_events ON comcat_events.event_id=perf.comcat_id "
+                    "ORDER BY perf.comcat_id, perf.fragility, perf.gmpe")
+                for row in op.cursor:
+                    fout.write("{row[comcat_id]} {mag} {row[gmpe]} {row[fragility]} {row[num_rows]:6d} {row[area_costsavings_eew]:6.2f} {row[area_costsavings_perfecteew]:6.2f} {row[population_costsavings_eew]:6.2f} {row[population_costsavings_perfecteew]:6.2f} {row[event_description]}\n".format(row=row, mag=eventMagnitude(row)))
+            else:
+                op.cursor.execute(
+                    "SELECT performance.*, " + eventColumns + " "
+                    "FROM performance LEFT JOIN comcat_events ON comcat_events.event_id=performance.comcat_id "
+                    "ORDER BY comcat_id, fragility, gmpe, magnitude_threshold, mmi_threshold, alert_latency_sec")
+                for row in op.cursor:
+                    fout.write("{row[comcat_id]} {mag} {row[gmpe]} {row[fragility]} {row[magnitude_threshold]:3.1f} {row[mmi_threshold]:3.1f} {row[alert_latency_sec]:3.1f} {row[area_costsavings_eew]:6.2f} {row[area_costsavings_perfecteew]:6.2f} {row[population_costsavings_eew]:6.2f} {row[population_costsavings_perfecteew]:6.2f} {row[event_description]}\n".format(row=row, mag=eventMagnitude(row)))
+        return
 
     def show_matches(self, server):
         """Show matches.
@@ -569,10 +1367,20 @@ class AnalysisData(object):
         with self.operation() as op:
             op.cursor.execute("SELECT * from comcat_events ORDER BY event_id")
             events = op.cursor.fetchall()
+
+        matches = self.find_matches([event["event_id"] for event in events], server)
+        alertId = "alert_id" if self.schema_version() >= 4 else "rowid"
+        with self.operation() as op:
+            alerts = {}
+            for matchId in matches.values():
+                if matchId is not None:
+                    op.cursor.execute("SELECT * FROM eew_alerts WHERE {}=?".format(alertId), (matchId,))
+                    alerts[matchId] = op.cursor.fetchone()
             
         for event in events:
-            alert = self.find_match(event["event_id"], server)
-            if alert:
+            matchId = matches[event["event_id"]]
+            if matchId is not None:
+                alert = alerts[matchId]
                 print("COMAT {event[event_id]} M{event[magnitude]:.2f} {event[longitude]:.3f} {event[latitude]:.3f} {event[origin_time]} ALERT {alert[event_id]} {alert[longitude]:.3f} {alert[latitude]:.3f} {alert[origin_time]} {alert[server]}".format(event=event, alert=alert))
             else:
                 print("COMAT {event[event_id]} M{event[magnitude]:.2f} {event[longitude]:.3f} {event[latitude]:.3f} {event[origin_time]} ALERT None".format(event=event))
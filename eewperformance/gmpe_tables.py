@@ -0,0 +1,255 @@
+# ======================================================================
+#
+#                           Brad T. Aagaard
+#                        U.S. Geological Survey
+#
+# ======================================================================
+#
+
+import os
+import logging
+import numpy
+
+from . import greatcircle
+
+# Increment when the table layout or the GMPE assumptions change.
+TABLE_VERSION = 1
+
+TABLES_DIR = os.path.join(os.path.dirname(__file__), "tables")
+
+DIST_OFFSET_KM = 1.0
+
+AXES = ("magnitude", "depth_km", "log_dist", "log_vs30")
+FIELDS = ("pgaG", "pgvCmps")
+
+# Tables loaded in this process, keyed by filename.
+TABLES = {}
+
+
+class GMPETable(object):
+    """Lookup table of log mean PGA (g) and PGV (cm/s) for a GMPE.
+
+    The table spans magnitude, hypocentral depth, log(rjb + 1 km), and
+    log(Vs30). With our point source, vertical strike-slip rupture
+    assumptions (see OpenQuakeGMPE) these determine the ground
+    motions, so we can predict ground motions without evaluating the
+    GMPE. We tabulate ground motions rather than MMI so that one table
+    serves all GMICE.
+    """
+
+    def __init__(self, gmpe, axes, values):
+        """Constructor.
+
+        :type gmpe: str
+        :param gmpe: Name of GMPE.
+
+        :type axes: dict
+        :param axes: Dictionary of Numpy arrays with table axes (AXES).
+
+        :type values: dict
+        :param values: Dictionary of Numpy arrays with log ground motions (FIELDS).
+        """
+        self.gmpe = gmpe
+        self.axes = axes
+        self.values = values
+        return
+
+    @staticmethod
+    def build(gmpe, magnitudes, depths, distances, vs30s):
+        """Build table by evaluating GMPE.
+
+        :type gmpe: str
+        :param gmpe: Name of GMPE.
+
+        :type magnitudes: Numpy array
+        :param magnitudes: Magnitudes of table.
+
+        :type depths: Numpy array
+        :param depths: Hypocentral depths (km) of table.
+
+        :type distances: Numpy array
+        :param distances: Joyner-Boore distances (km) of table; uniformly spaced in log(rjb + 1 km) works best.
+
+        :type vs30s: Numpy array
+        :param vs30s: Vs30 values (m/s) of table.
+
+        :returns: GMPETable
+        """
+        from . import openquake_gmpe
+
+        oqGMPE = openquake_gmpe.get_gmpe(gmpe)
+        axes = {
+            "magnitude": numpy.asarray(magnitudes, dtype=numpy.float64),
+            "depth_km": numpy.asarray(depths, dtype=numpy.float64),
+            "log_dist": numpy.log(numpy.asarray(distances, dtype=numpy.float64) + DIST_OFFSET_KM),
+            "log_vs30": numpy.log(numpy.asarray(vs30s, dtype=numpy.float64)),
+        }
+        shape = tuple(axes[name].shape[0] for name in AXES)
+        values = {field: numpy.zeros(shape, dtype=numpy.float32) for field in FIELDS}
+        for imag, magnitude in enumerate(axes["magnitude"]):
+            for idepth, depth in enumerate(axes["depth_km"]):
+                ruptureContext = oqGMPE._ruptureContext({"magnitude": magnitude, "depth_km": depth})
+                table = oqGMPE._computeMeanTable(ruptureContext, axes["log_dist"], axes["log_vs30"], DIST_OFFSET_KM)
+                for field in FIELDS:
+                    values[field][imag,idepth] = table[field]
+            logging.getLogger(__name__).debug("Built {} table for magnitude {:.2f}.".format(gmpe, magnitude))
+        return GMPETable(gmpe, axes, values)
+
+    @staticmethod
+    def load(filename):
+        """Load table from file.
+
+        :type filename: str
+        :param filename: Name of table file (.npz).
+
+        :returns: GMPETable
+        """
+        with numpy.load(filename) as data:
+            version = int(data["version"])
+            if version != TABLE_VERSION:
+                raise ValueError("GMPE table '{}' has version {}, expected version {}. Rebuild the table.".format(filename, version, TABLE_VERSION))
+            gmpe = str(data["gmpe"])
+            axes = {name: data[name] for name in AXES}
+            values = {field: data[field] for field in FIELDS}
+        return GMPETable(gmpe, axes, values)
+
+    def save(self, filename):
+        """Save table to file.
+
+        :type filename: str
+        :param filename: Name of table file (.npz).
+        """
+        import tempfile
+
+        dirname = os.path.dirname(filename) or "."
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        arrays = dict(self.axes)
+        arrays.update(self.values)
+        (fd, tmpFilename) = tempfile.mkstemp(suffix=".npz", dir=dirname)
+        with os.fdopen(fd, "wb") as fout:
+            numpy.savez(fout, version=TABLE_VERSION, gmpe=self.gmpe, **arrays)
+        os.rename(tmpFilename, filename)
+        return
+
+    def computeMean(self, event, points):
+        """Compute mean PGA (g) and PGV (cm/s) by interpolating table.
+
+        Values outside the table are clamped to the table edges.
+
+        :type event: dict
+        :param event:
+            Dictionary with event parameters ["magnitude", "longitude", "latitude", "depth_km"]
+
+        :type points: dict of Numpy arrays or Numpy structured array
+        :param points:
+            Point locations and metadata ["longitude", "latitude", "vs30"].
+
+        :returns: Numpy structured array with PGA and PGV at points.
+        """
+        for name, value in (("magnitude", event["magnitude"]), ("depth_km", event["depth_km"])):
+            axis = self.axes[name]
+            if value < axis[0] or value > axis[-1]:
+                logging.getLogger(__name__).warning("Event {} {} is outside {} table range [{}, {}].".format(name, value, self.gmpe, axis[0], axis[-1]))
+
+        distKm = 1.0e-3*greatcircle.distance_points(event["longitude"], event["latitude"], points)
+        coords = (
+            event["magnitude"],
+            event["depth_km"],
+            numpy.log(distKm + DIST_OFFSET_KM),
+            numpy.log(numpy.asarray(points["vs30"], dtype=numpy.float64)),
+        )
+        axes = [self.axes[name] for name in AXES]
+
+        dtype = {
+            "names": sorted(FIELDS),
+            "formats": ["float64"]*len(FIELDS),
+        }
+        data = numpy.zeros(distKm.shape[0], dtype=dtype)
+        for field in FIELDS:
+            data[field] = numpy.exp(interpolate(self.values[field], axes, coords))
+        return data
+
+
+def table_filename(gmpe, tablesDir=None):
+    """Get name of table file for GMPE.
+
+    :type gmpe: str
+    :param gmpe: Name of GMPE.
+
+    :type tablesDir: str
+    :param tablesDir: Directory with tables (default is TABLES_DIR).
+    """
+    return os.path.join(tablesDir or TABLES_DIR, "{}.npz".format(gmpe))
+
+
+def get_table(gmpe, tablesDir=None):
+    """Get table for GMPE, loading it from file the first time.
+
+    :type gmpe: str
+    :param gmpe: Name of GMPE.
+
+    :type tablesDir: str
+    :param tablesDir: Directory with tables (default is TABLES_DIR).
+    """
+    filename = table_filename(gmpe, tablesDir)
+    if not filename in TABLES:
+        if not os.path.isfile(filename):
+            raise IOError("Could not find GMPE table '{}'. Generate it with generate_gmpe_tables.py.".format(filename))
+        TABLES[filename] = GMPETable.load(filename)
+    return TABLES[filename]
+
+
+def interpolate(table, axes, coords):
+    """Multilinear interpolation of table.
+
+    Coordinates may be scalars or arrays; they are broadcast against
+    each other. Coordinates outside the axes are clamped to the edges
+    of the table.
+
+    :type table: Numpy array
+    :param table: N-dimensional table of values.
+
+    :type axes: list of Numpy arrays
+    :param axes: Monotonically increasing axis for each dimension of table.
+
+    :type coords: tuple
+    :param coords: Coordinates along each axis of points.
+
+    :returns: Numpy array with values interpolated at points.
+    """
+    indices = []
+    weights = []
+    for axis, x in zip(axes, coords):
+        x = numpy.asarray(x, dtype=numpy.float64)
+        if axis.shape[0] == 1:
+            indices.append(numpy.zeros(x.shape, dtype=numpy.int64))
+            weights.append(numpy.zeros(x.shape))
+            continue
+        i = numpy.clip(numpy.searchsorted(axis, x, side="right")-1, 0, axis.shape[0]-2)
+        w = numpy.clip((x-axis[i])/(axis[i+1]-axis[i]), 0.0, 1.0)
+        indices.append(i)
+        weights.append(w)
+
+    # Sum contributions from 2**N corners of the cells. Dimensions of
+    # size 1 have zero weight on the upper corner, so we reuse the
+    # lower index for them.
+    value = 0.0
+    numDims = len(axes)
+    for corner in range(2**numDims):
+        cornerIndex = []
+        cornerWeight = 1.0
+        for idim in range(numDims):
+            upper = (corner >> idim) & 1
+            if upper and axes[idim].shape[0] == 1:
+                cornerWeight = None
+                break
+            cornerIndex.append(indices[idim]+upper)
+            cornerWeight = cornerWeight * (weights[idim] if upper else 1.0-weights[idim])
+        if cornerWeight is None:
+            continue
+        value = value + cornerWeight*table[tuple(cornerIndex)]
+    return value
+
+
+# End of file
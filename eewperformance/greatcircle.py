@@ -40,6 +40,31 @@ def distance(refLon, refLat, ptsLon, ptsLat):
         + numpy.cos(refLatR)*numpy.cos(ptsLatR)*numpy.sin(0.5*(ptsLonR-refLonR))**2
     return EARTH_MEAN_RADIUS_M * 2.0*numpy.arcsin(p**0.5)
 
+def distance_points(refLon, refLat, points):
+    """Get great circle distance in meters from reference point to points.
+
+    If the points are on a regular grid (they provide `axes()`), we
+    exploit the separability of the great circle distance in
+    longitude and latitude and avoid creating the longitude and
+    latitude of every point.
+
+    :type refLon: float
+    :param refLon: Longitude of reference point in degrees.
+
+    :type refLat: float
+    :param refLat: Latitude of reference point in degrees.
+
+    :type points: Numpy structured array or shakemap.RegularGrid
+    :param points: Points with 'longitude' and 'latitude'.
+
+    :returns: Numpy array of distances for points (flattened for a regular grid).
+    """
+    if hasattr(points, "axes"):
+        lon, lat = points.axes()
+        return distance(refLon, refLat, lon[numpy.newaxis,:], lat[:,numpy.newaxis]).ravel()
+    return distance(refLon, refLat, points["longitude"], points["latitude"])
+
+
 def area_km2(lon, lat, dLon, dLat, destSRS):
     """Compute area associated with points in projected coordinate system.
 
@@ -534,24 +534,16 @@ class SummaryMaps(object):
         fragility = self.config.get("fragility_curves", "label")
         alertLatency = self.config.getfloat("alerts", "alert_latency_sec")
         
-        perfs = None
-        for eqId in self.events:
-            p = self.db.performance_stats(eqId, server, gmpe, fragility, alertLatency)
-            if perfs is None:
-                perfs = p
-            else:
-                perfs = numpy.append(perfs, p)
-
         mmiThreshold = self.config.getfloat("alerts", "mmi_threshold")
         magThreshold = self.config.getfloat("alerts", "magnitude_threshold")
-        mask = numpy.logical_and(numpy.ma.masked_values(perfs["mmi_threshold"], mmiThreshold).mask,
-                                 numpy.ma.masked_values(perfs["magnitude_threshold"], magThreshold).mask)
-        perfs = perfs[mask]
+        perfs = self.db.performance_stats_events(self.events, server, gmpe, fragility, alertLatency, magThreshold, mmiThreshold)
         
         eqs = numpy.zeros(len(self.events), dtype=COLS)
-        for i,p in enumerate(perfs):
-            event = self.db.comcat_event(p["comcat_id"].decode())
-            eqs[i] = (event["longitude"], event["latitude"], event["magnitude"], p[metric])
+        numPerfs = perfs.shape[0]
+        eqs["longitude"][:numPerfs] = perfs["event_longitude"]
+        eqs["latitude"][:numPerfs] = perfs["event_latitude"]
+        eqs["magnitude"][:numPerfs] = perfs["event_magnitude"]
+        eqs["cost_savings"][:numPerfs] = perfs[metric]
             
         extent = [
             numpy.min(eqs["longitude"])-2.0, numpy.max(eqs["longitude"])+2.0,
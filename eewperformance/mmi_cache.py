@@ -0,0 +1,209 @@
+# ======================================================================
+#
+#                           Brad T. Aagaard
+#                        U.S. Geological Survey
+#
+# ======================================================================
+#
+
+import os
+import hashlib
+import logging
+import collections
+import numpy
+
+
+class PredictedMMICache(object):
+    """Cache of predicted MMI rasters for alerts.
+
+    Predicted MMI for an alert depends only on the alert location,
+    magnitude, and depth, the GMPE, the GMICE, the prediction
+    function, and the grid. We keep the most recently used rasters in
+    memory up to a memory budget and, optionally, store rasters on
+    disk up to a disk budget, removing the least recently used files
+    first.
+    """
+
+    def __init__(self, maxBytes, cacheDir=None, maxDiskBytes=None):
+        """Constructor.
+
+        :type maxBytes: int
+        :param maxBytes: Maximum number of bytes of rasters kept in memory.
+
+        :type cacheDir: str
+        :param cacheDir: Directory for rasters stored on disk (None for no disk cache).
+
+        :type maxDiskBytes: int
+        :param maxDiskBytes: Maximum number of bytes of rasters stored on disk (None for no limit).
+        """
+        self.maxBytes = maxBytes
+        self.cacheDir = cacheDir
+        self.maxDiskBytes = maxDiskBytes
+        self.diskBytes = None
+        self.nbytes = 0
+        self.rasters = collections.OrderedDict()
+        return
+
+    def key(self, function, alert, gridKey, gmpe, gmice):
+        """Get cache key for predicted MMI raster.
+
+        :type function: str
+        :param function: Full name of function for predicted MMI.
+
+        :type alert: dict
+        :param alert: ShakeAlert alert dictionary.
+
+        :type gridKey: str
+        :param gridKey: Key for ShakeMap grid.
+
+        :type gmpe: str
+        :param gmpe: Name of GMPE.
+
+        :type gmice: str
+        :param gmice: Name of GMICE.
+        """
+        fields = (
+            function,
+            gridKey,
+            gmpe,
+            gmice,
+            repr(float(alert["longitude"])),
+            repr(float(alert["latitude"])),
+            repr(float(alert["magnitude"])),
+            repr(float(alert["depth_km"])),
+        )
+        return hashlib.sha1(" ".join(map(str, fields)).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Get predicted MMI raster from cache.
+
+        :type key: str
+        :param key: Cache key for raster.
+        :returns: Numpy array with predicted MMI or None if not in cache.
+        """
+        if key in self.rasters:
+            self.rasters.move_to_end(key)
+            return self.rasters[key]
+        filename = self._filename(key)
+        if filename and os.path.isfile(filename):
+            try:
+                value = numpy.load(filename)
+                os.utime(filename)
+            except (IOError, OSError, ValueError):
+                # File was removed or is incomplete.
+                return None
+            self._add(key, value)
+            return value
+        return None
+
+    def put(self, key, value):
+        """Add predicted MMI raster to cache.
+
+        :type key: str
+        :param key: Cache key for raster.
+
+        :type value: Numpy array
+        :param value: Predicted MMI.
+        """
+        filename = self._filename(key)
+        if filename and not os.path.isfile(filename):
+            if not os.path.isdir(self.cacheDir):
+                os.makedirs(self.cacheDir)
+            tmpFilename = "{}.{}.tmp.npy".format(filename[:-4], os.getpid())
+            numpy.save(tmpFilename, value)
+            os.rename(tmpFilename, filename)
+            self._add_disk(os.path.getsize(filename))
+        self._add(key, value)
+        return
+
+    def clear(self):
+        """Remove all rasters from memory.
+        """
+        self.rasters.clear()
+        self.nbytes = 0
+        return
+
+    def _add(self, key, value):
+        """Add raster to memory, evicting least recently used rasters to stay within memory budget.
+        """
+        value.setflags(write=False)
+        if key in self.rasters:
+            self.nbytes -= self.rasters.pop(key).nbytes
+        self.rasters[key] = value
+        self.nbytes += value.nbytes
+        while self.nbytes > self.maxBytes and len(self.rasters) > 0:
+            keyOld, valueOld = self.rasters.popitem(last=False)
+            self.nbytes -= valueOld.nbytes
+            logging.getLogger(__name__).debug("Evicted predicted MMI raster {} from memory.".format(keyOld))
+        return
+
+    def _add_disk(self, nbytes):
+        """Account for raster written to disk, removing least recently used files to stay within disk budget.
+
+        Other processes may write to the same directory, so we rescan
+        the directory before removing files.
+        """
+        if self.maxDiskBytes is None:
+            return
+        if self.diskBytes is None:
+            self.diskBytes = sum([size for mtime, size, filename in self._disk_files()])
+        else:
+            self.diskBytes += nbytes
+        if self.diskBytes <= self.maxDiskBytes:
+            return
+
+        files = sorted(self._disk_files())
+        self.diskBytes = sum([size for mtime, size, filename in files])
+        for mtime, size, filename in files:
+            if self.diskBytes <= self.maxDiskBytes:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            self.diskBytes -= size
+            logging.getLogger(__name__).debug("Removed predicted MMI raster {} from disk.".format(filename))
+        return
+
+    def _disk_files(self):
+        """Get modification time, size, and name of raster files on disk.
+        """
+        files = []
+        for name in os.listdir(self.cacheDir):
+            if not (name.startswith("mmi-") and name.endswith(".npy")) or name.endswith(".tmp.npy"):
+                continue
+            filename = os.path.join(self.cacheDir, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, filename))
+        return files
+
+    def _filename(self, key):
+        return os.path.join(self.cacheDir, "mmi-"+key+".npy") if self.cacheDir else None
+
+
+_cache = None
+
+def get_cache(maxBytes, cacheDir=None, maxDiskBytes=None):
+    """Get predicted MMI cache for this process.
+
+    :type maxBytes: int
+    :param maxBytes: Maximum number of bytes of rasters kept in memory.
+
+    :type cacheDir: str
+    :param cacheDir: Directory for rasters stored on disk (None for no disk cache).
+
+    :type maxDiskBytes: int
+    :param maxDiskBytes: Maximum number of bytes of rasters stored on disk (None for no limit).
+    """
+    global _cache
+    if _cache is None or _cache.cacheDir != cacheDir:
+        _cache = PredictedMMICache(maxBytes, cacheDir, maxDiskBytes)
+    _cache.maxBytes = maxBytes
+    _cache.maxDiskBytes = maxDiskBytes
+    return _cache
+
+
+# End of file
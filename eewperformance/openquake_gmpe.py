@@ -8,6 +8,7 @@
 
 
 import logging
+import collections
 import numpy
 
 from . import greatcircle
@@ -17,6 +18,22 @@ import openquake.hazardlib.imt
 import openquake.hazardlib.const
 
 
+# GMPEs created in this process, keyed by name.
+GMPES = {}
+
+
+def get_gmpe(name):
+    """Get OpenQuakeGMPE for name, creating it the first time.
+
+    :type name: str
+    :param name:
+        Name for GMPE [BSSA2014, ASK2014, CB2014, CY2014]
+    """
+    if not name in GMPES:
+        GMPES[name] = OpenQuakeGMPE(name)
+    return GMPES[name]
+
+
 # ----------------------------------------------------------------------
 class OpenQuakeGMPE(object):
     """
@@ -26,6 +43,9 @@ class OpenQuakeGMPE(object):
         "pgaG": openquake.hazardlib.imt.PGA(),
         "pgvCmps": openquake.hazardlib.imt.PGV(),
     }
+
+    # Number of site contexts (Vs30 grids) kept by each GMPE.
+    SITES_CACHE_SIZE = 4
     
     def __init__(self, name):
         """
@@ -49,6 +69,7 @@ class OpenQuakeGMPE(object):
             self.gmpe = openquake.hazardlib.gsim.chiou_youngs_2014.ChiouYoungs2014()
         else:
             raise ValueError("Unknown OpenQuake GMPE '%s'." % name)
+        self.sitesCache = collections.OrderedDict()
         return
 
     def computeMean(self, event, points):
@@ -68,25 +89,159 @@ class OpenQuakeGMPE(object):
         
         """
         ruptureContext = self._ruptureContext(event)
-        sitesContext = self._sitesContext(points)
+        sitesContext = self._sitesContextCached(points)
         distContext = self._distanceContext(event, points, ruptureContext)
+        return self._computeMeanContexts(ruptureContext, sitesContext, distContext)
 
-        fields = OpenQuakeGMPE.FIELDS
+    def computeMeanRadial(self, event, points, maxError=0.01):
+        """
+        Compute mean PGA (g) and PGV (cm/s) using a table over Joyner-Boore distance and Vs30.
+
+        With our point source, vertical strike-slip rupture
+        assumptions, the ground motion depends only on Joyner-Boore
+        distance and Vs30 for a given event. We evaluate the GMPE on a
+        table of distances (uniformly spaced in log(rjb + 1 km)) and
+        Vs30 values (the unique values or log-spaced bins) and
+        interpolate log ground motion bilinearly to the points.
+
+        We estimate the interpolation error by evaluating the GMPE at
+        the centers of the table cells and refine the table until the
+        error is less than maxError (or the maximum resolution is
+        reached). The estimated error is stored in interpolationError.
+
+        :type event: dict
+        :param event:
+            Dictionary with event parameters ["magnitude", "longitude", "latitude", "depth_km"]
+
+        :type points: dict of Numpy arrays or Numpy structured array
+        :param points:
+            Point locations and metadata ["longitude", "latitude", "vs30"].
+
+        :type maxError: float
+        :param maxError: Maximum interpolation error in natural log units.
+
+        :returns: Numpy structured array with PGA and PGV at points.
+        """
+        DIST_OFFSET_KM = 1.0
+        NUM_DIST_PER_UNIT = 8 # number of distances per natural log unit
+        NUM_VS30 = 16
+        NUM_REFINE = 3
+
+        ruptureContext = self._ruptureContext(event)
+        rjb = 1.0e-3*greatcircle.distance_points(event["longitude"], event["latitude"], points)
+        vs30 = numpy.asarray(points["vs30"], dtype=numpy.float64)
+
+        xPoints = numpy.log(rjb + DIST_OFFSET_KM)
+        xMin = numpy.min(xPoints)
+        xMax = numpy.max(xPoints)
+        vs30Unique = numpy.unique(vs30)
         
-        numFields = len(fields.keys())
-        numPoints = points["longitude"].shape[0]
-        dtype = {
-            "names": [s for s in sorted(fields.keys())],
-            "formats": ["float64"]*numFields,
-        }
-        data = numpy.zeros(numPoints, dtype=dtype)
+        numDistPerUnit = NUM_DIST_PER_UNIT
+        numVs30 = NUM_VS30
+        for irefine in range(NUM_REFINE+1):
+            numDist = max(2, int(numpy.ceil((xMax-xMin)*numDistPerUnit))+1)
+            xAxis = numpy.linspace(xMin, xMax, numDist)
+            if vs30Unique.shape[0] <= numVs30:
+                vAxis = numpy.log(vs30Unique)
+            else:
+                vAxis = numpy.linspace(numpy.log(vs30Unique[0]), numpy.log(vs30Unique[-1]), numVs30)
+            table = self._computeMeanTable(ruptureContext, xAxis, vAxis, DIST_OFFSET_KM)
+
+            # Estimate interpolation error at centers of table cells.
+            xMid = 0.5*(xAxis[:-1]+xAxis[1:])
+            vMid = 0.5*(vAxis[:-1]+vAxis[1:]) if vAxis.shape[0] > 1 else vAxis
+            exact = self._computeMeanTable(ruptureContext, xMid, vMid, DIST_OFFSET_KM)
+            xMesh, vMesh = numpy.meshgrid(xMid, vMid, indexing="ij")
+            self.interpolationError = 0.0
+            for field in self.FIELDS:
+                interp = self._interpolate(table[field], xAxis, vAxis, xMesh.ravel(), vMesh.ravel())
+                error = numpy.max(numpy.abs(interp - exact[field].ravel()))
+                self.interpolationError = max(self.interpolationError, error)
+            if self.interpolationError <= maxError:
+                break
+            numDistPerUnit *= 2
+            numVs30 *= 2
+        logging.getLogger(__name__).debug("GMPE table with {} distances and {} Vs30 values, interpolation error {:.4f}.".format(xAxis.shape[0], vAxis.shape[0], self.interpolationError))
+        if self.interpolationError > maxError:
+            logging.getLogger(__name__).warning("GMPE table interpolation error {:.4f} exceeds {:.4f}.".format(self.interpolationError, maxError))
+
+        data = numpy.zeros(rjb.shape[0], dtype=self._dtype())
+        vPoints = numpy.log(vs30)
+        for field in self.FIELDS:
+            data[field] = numpy.exp(self._interpolate(table[field], xAxis, vAxis, xPoints, vPoints))
+        return data
+
+    def _computeMeanTable(self, ruptureContext, xAxis, vAxis, distOffsetKm):
+        """Compute log of mean PGA (g) and PGV (cm/s) on table of distance and Vs30.
 
-        for field in fields:
+        :type xAxis: Numpy array
+        :param xAxis: Distance axis, log(rjb + distOffsetKm).
+
+        :type vAxis: Numpy array
+        :param vAxis: Vs30 axis, log(vs30).
+
+        :returns: Dictionary of Numpy arrays (distance, vs30) with log of PGA and PGV.
+        """
+        xMesh, vMesh = numpy.meshgrid(xAxis, vAxis, indexing="ij")
+        rjb = numpy.maximum(0.0, numpy.exp(xMesh.ravel()) - distOffsetKm)
+        sitesContext = self._sitesContext({"vs30": numpy.exp(vMesh.ravel())})
+        distContext = self._distanceContextRjb(rjb, ruptureContext)
+        data = self._computeMeanContexts(ruptureContext, sitesContext, distContext)
+        return {field: numpy.log(data[field]).reshape(xMesh.shape) for field in self.FIELDS}
+
+    @staticmethod
+    def _interpolate(table, xAxis, vAxis, x, v):
+        """Bilinear interpolation of table with regular axes.
+
+        :type table: Numpy array
+        :param table: Table of values (x, v).
+
+        :type xAxis: Numpy array
+        :param xAxis: Uniformly spaced x axis.
+
+        :type vAxis: Numpy array
+        :param vAxis: Monotonically increasing v axis.
+
+        :returns: Values interpolated at points (x,v).
+        """
+        dx = (xAxis[-1]-xAxis[0]) / (xAxis.shape[0]-1)
+        if dx > 0.0:
+            ix = numpy.clip(((x-xAxis[0])/dx).astype(numpy.int64), 0, xAxis.shape[0]-2)
+            wx = numpy.clip((x-xAxis[ix])/dx, 0.0, 1.0)
+        else:
+            # All points at the same distance, so the x axis is degenerate.
+            ix = numpy.zeros(x.shape, dtype=numpy.int64)
+            wx = numpy.zeros(x.shape)
+        if vAxis.shape[0] > 1:
+            iv = numpy.clip(numpy.searchsorted(vAxis, v, side="right")-1, 0, vAxis.shape[0]-2)
+            wv = numpy.clip((v-vAxis[iv])/(vAxis[iv+1]-vAxis[iv]), 0.0, 1.0)
+        else:
+            iv = numpy.zeros(x.shape, dtype=numpy.int64)
+            wv = numpy.zeros(x.shape)
+            table = numpy.hstack((table, table))
+        return (1.0-wx)*((1.0-wv)*table[ix,iv] + wv*table[ix,iv+1]) + wx*((1.0-wv)*table[ix+1,iv] + wv*table[ix+1,iv+1])
+
+    def _computeMeanContexts(self, ruptureContext, sitesContext, distContext):
+        """Compute mean PGA (g) and PGV (cm/s) for OpenQuake contexts.
+        """
+        data = numpy.zeros(sitesContext.vs30.shape[0], dtype=self._dtype())
+        for field in self.FIELDS:
             imt = self.FIELDS[field]
             (values,stddev) = self.gmpe.get_mean_and_stddevs(sitesContext, ruptureContext, distContext, imt, [openquake.hazardlib.const.StdDev.TOTAL])
             data[field] = self.gmpe.to_imt_unit_values(values)
         return data
 
+    def _dtype(self):
+        """Get Numpy dtype for ground motion values.
+        """
+        fields = OpenQuakeGMPE.FIELDS
+        numFields = len(fields.keys())
+        dtype = {
+            "names": [s for s in sorted(fields.keys())],
+            "formats": ["float64"]*numFields,
+        }
+        return dtype
+
     def _ruptureContext(self, event):
         """Set rupture parameters. 
 
@@ -136,6 +291,32 @@ class OpenQuakeGMPE(object):
         context.vs30measured = False*numpy.ones(points["vs30"].shape, dtype=numpy.bool)
         return context
 
+    def _sitesContextCached(self, points):
+        """Get site parameters, reusing the context for the same Vs30 array.
+
+        Vs30 does not change within an event, so repeated alerts for
+        a ShakeMap reuse the site context. We identify the Vs30 array
+        by the address, shape, and strides of its buffer and keep a
+        reference to it, so the buffer cannot be reused by another
+        array while the context is cached.
+
+        :type points: dict of Numpy arrays or Numpy structured array
+        :param points:
+            Point locations and metadata ["vs30"].
+        """
+        vs30 = points["vs30"]
+        if not isinstance(vs30, numpy.ndarray):
+            return self._sitesContext(points)
+        key = (vs30.__array_interface__["data"][0], vs30.shape, vs30.strides, vs30.dtype.str)
+        if key in self.sitesCache:
+            self.sitesCache.move_to_end(key)
+            return self.sitesCache[key][1]
+        context = self._sitesContext(points)
+        self.sitesCache[key] = (vs30, context)
+        while len(self.sitesCache) > self.SITES_CACHE_SIZE:
+            self.sitesCache.popitem(last=False)
+        return context
+
     def _distanceContext(self, event, points, ruptureContext):
         """Get rupture distance information using great circle path.
 
@@ -151,8 +332,16 @@ class OpenQuakeGMPE(object):
         :param points:
             Point locations and metadata ["longitude", "latitude"].
         """
+        distEpiKm = 1.0e-3*greatcircle.distance_points(event["longitude"], event["latitude"], points)
+        return self._distanceContextRjb(distEpiKm, ruptureContext)
+
+    def _distanceContextRjb(self, distEpiKm, ruptureContext):
+        """Get rupture distance information from Joyner-Boore distance.
+
+        :type distEpiKm: Numpy array
+        :param distEpiKm: Joyner-Boore (epicentral) distance in km.
+        """
         context = openquake.hazardlib.gsim.base.DistancesContext()
-        distEpiKm = 1.0e-3*greatcircle.distance(event["longitude"], event["latitude"], points["longitude"], points["latitude"])
         distRupKm = (distEpiKm**2 + ruptureContext.ztor**2)**0.5 # Assumes vertical fault and point source (ignore strike)
         context.rjb = distEpiKm
         context.rrup = distRupKm
@@ -13,6 +13,7 @@ import numpy
 
 from . import analysis_utils
 from . import gdalraster
+from . import mmi_cache
 
 class CostSavings(object):
     """Cost savings weighted by area and population.
@@ -24,12 +25,94 @@ class CostSavings(object):
 
     def compute(self, event, shakemap, alerts, shakingTime, populationDensity, magAlertThreshold, mmiAlertThreshold, plotAlertMaps=False):
 
-        functionPath = self.config.get("mmi_predicted", "function").split(".")
+        mmiPred, warningTimes = self._predicted(event, shakemap, alerts, shakingTime, magAlertThreshold, [mmiAlertThreshold], plotAlertMaps)
+
+        filename = "analysis_" + analysis_utils.analysis_event_label(self.config, event["event_id"], magAlertThreshold, mmiAlertThreshold) + ".tiff"
+        metrics = self._cost(mmiPred, shakemap, warningTimes[0], populationDensity, mmiAlertThreshold, filename)
+        return metrics
+
+    def first_alert_index(self, alerts, shakingTime, magAlertThreshold):
+        """Get index of first alert used for magnitude alert threshold.
+
+        The magnitude alert threshold only determines the first alert
+        used; all later alerts with positive warning times are also
+        used. Magnitude thresholds with the same first alert give
+        identical results.
+
+        :type alerts: list
+        :param alerts: ShakeAlert alerts for event.
+
+        :type shakingTime: Numpy array
+        :param shakingTime: Shaking time at points.
+
+        :type magAlertThreshold: float
+        :param magAlertThreshold: Magnitude alert threshold.
+
+        :returns: Index of first alert or None if threshold is never reached.
+        """
+        alertLatency = numpy.timedelta64(int(self.config.getfloat("alerts", "alert_latency_sec")*1.0e+3), "ms")
+        shakingTimeMax = numpy.max(shakingTime)
+        for ialert, alert in enumerate(alerts):
+            alertTime = numpy.datetime64(alert["timestamp"]) + alertLatency
+            if alertTime > shakingTimeMax:
+                continue
+            if alert["magnitude"] >= magAlertThreshold:
+                return ialert
+        return None
+
+    def sweep(self, event, shakemap, alerts, shakingTime, populationDensity, magAlertThreshold, mmiThresholds, rasters=[]):
+        """Compute cost savings metrics for a sequence of MMI alert thresholds.
+
+        For a given sequence of alerts, the predicted MMI used in the
+        cost of taking action does not depend on the MMI alert
+        threshold; the threshold only selects which pixels are
+        alerted. We compute the predicted MMI once, sort the pixels by
+        predicted MMI, and evaluate the metrics for all thresholds
+        using cumulative sums.
+
+        :type mmiThresholds: Numpy array
+        :param mmiThresholds: MMI alert thresholds.
+
+        :type rasters: list
+        :param rasters: Tuples of magnitude and MMI alert thresholds for which to write analysis rasters. The magnitude thresholds should have the same first alert as magAlertThreshold.
+
+        :returns: List of metrics dictionaries, one per MMI alert threshold.
+        """
+        rasterMMIThresholds = sorted(set([mmiThreshold for magThreshold, mmiThreshold in rasters]))
+        mmiPred, warningTimes = self._predicted(event, shakemap, alerts, shakingTime, magAlertThreshold, rasterMMIThresholds)
+        metrics = self._cost_sweep(mmiPred, shakemap, populationDensity, mmiThresholds)
+
+        for magThreshold, mmiThreshold in rasters:
+            warningTime = warningTimes[rasterMMIThresholds.index(mmiThreshold)]
+            filename = "analysis_" + analysis_utils.analysis_event_label(self.config, event["event_id"], magThreshold, mmiThreshold) + ".tiff"
+            self._cost(mmiPred, shakemap, warningTime, populationDensity, mmiThreshold, filename)
+        return metrics
+
+    def _predicted(self, event, shakemap, alerts, shakingTime, magAlertThreshold, mmiThresholds, plotAlertMaps=False):
+        """Compute predicted MMI and warning times from alerts.
+
+        The predicted MMI at a pixel is the maximum predicted MMI over
+        alerts with positive warning time and is independent of the
+        MMI alert threshold. The warning time at a pixel depends on
+        the MMI alert threshold, so we compute it for each threshold
+        in mmiThresholds.
+
+        :type mmiThresholds: list
+        :param mmiThresholds: MMI alert thresholds for warning times.
+
+        :returns: Tuple of predicted MMI and list of warning times (one per MMI alert threshold).
+        """
+        functionName = self.config.get("mmi_predicted", "function")
+        functionPath = functionName.split(".")
         fn = getattr(import_module(".".join(functionPath[:-1])), functionPath[-1])
+        cacheDir = self.config.get("files", "mmi_cache_dir") if self.config.has_option("files", "mmi_cache_dir") else None
+        cacheMemory = self.config.getfloat("mmi_predicted", "cache_memory_mb") if self.config.has_option("mmi_predicted", "cache_memory_mb") else 0.0
+        cacheDisk = self.config.getfloat("mmi_predicted", "cache_disk_mb") if self.config.has_option("mmi_predicted", "cache_disk_mb") else None
+        cache = mmi_cache.get_cache(int(cacheMemory*1024**2), cacheDir or None, None if cacheDisk is None else int(cacheDisk*1024**2))
             
         shape = shakemap.data["mmi"].shape
         warningTimeZero = numpy.zeros((1,), dtype="timedelta64[us]")
-        warningTime = gdalraster.NO_DATA_VALUE * 1.0e+6 * numpy.ones(shape, dtype="timedelta64[us]")
+        warningTimes = [gdalraster.NO_DATA_VALUE * 1.0e+6 * numpy.ones(shape, dtype="timedelta64[us]") for mmiThreshold in mmiThresholds]
         mmiPred = gdalraster.NO_DATA_VALUE * numpy.ones(shape, numpy.float32)
 
         gmpe = self.config.get("mmi_predicted", "gmpe")
@@ -58,14 +141,18 @@ class CostSavings(object):
                     logging.getLogger(__name__).info(msg)
                     thresholdReached = True
                 
-            mmiPredCur = fn(alert, shakemap.data, gmpe, gmice)
+            cacheKey = cache.key(functionName, alert, shakemap.grid_key(), gmpe, gmice)
+            mmiPredCur = cache.get(cacheKey)
+            if mmiPredCur is None:
+                mmiPredCur = fn(alert, shakemap.data, gmpe, gmice)
+                cache.put(cacheKey, mmiPredCur)
             warningTimeCur = shakingTime - alertTime
             
             if plotAlertMaps:
                 plotsDir = self.config.get("files", "plots_dir")
                 if not os.path.isdir(plotsDir):
                     os.makedirs(plotsDir)
-                filename = analysis_utils.analysis_event_label(self.config, self.eqId, magAlertThreshold, mmiAlertThreshold)+"_alert_snapshot.tiff"
+                filename = analysis_utils.analysis_event_label(self.config, self.eqId, magAlertThreshold, mmiThresholds[0])+"_alert_snapshot.tiff"
                 values = [
                     ("mmi_pred", mmiPredCur,),
                     ("warning_time", analysis_utils.timedelta_to_seconds(warningTimeCur),),
@@ -77,8 +164,9 @@ class CostSavings(object):
                 mapPanels.mmi_warning_time(tafterOT)
             
             # Update alert time if greater than previous
-            maskAlert = numpy.bitwise_and(warningTimeCur > warningTime, mmiPredCur >= mmiAlertThreshold)
-            warningTime[maskAlert] = warningTimeCur[maskAlert]
+            for mmiAlertThreshold, warningTime in zip(mmiThresholds, warningTimes):
+                maskAlert = numpy.bitwise_and(warningTimeCur > warningTime, mmiPredCur >= mmiAlertThreshold)
+                warningTime[maskAlert] = warningTimeCur[maskAlert]
 
             # Update predicted MMI if greater than previous AND
             # positive warning time. Assumes action will be taken if
@@ -87,22 +175,25 @@ class CostSavings(object):
             maskMMI = numpy.bitwise_and(mmiPredCur > mmiPred, warningTimeCur >= warningTimeZero)
             mmiPred[maskMMI] = mmiPredCur[maskMMI]
 
-        filename = "analysis_" + analysis_utils.analysis_event_label(self.config, event["event_id"], magAlertThreshold, mmiAlertThreshold) + ".tiff"
-        metrics = self._cost(mmiPred, shakemap, warningTime, populationDensity, mmiAlertThreshold, filename)
-        return metrics
+        return (mmiPred, warningTimes)
 
-    def _cost(self, mmiPred, shakemap, warningTime, populationDensity, mmiAlertThreshold, filename):
-        """Compute cost savings metrics.
+    def _fragility(self):
+        """Create fragility curves object from configuration.
         """
-        mmiObs = shakemap.data["mmi"]
-        
-        # Compute costNoEEW, costEEW, costPerfectEEW, costSavings
         objectPath = self.config.get("fragility_curves", "object").split(".")
         fragilityOptions = dict(self.config.items("fragility_curves"))
         fragilityOptions.pop("object")
         fragilityOptions.pop("label")
         fragilityOptions = {k: float(v) for k,v in fragilityOptions.items()}
-        fragility = getattr(import_module(".".join(objectPath[:-1])), objectPath[-1])(**fragilityOptions)
+        return getattr(import_module(".".join(objectPath[:-1])), objectPath[-1])(**fragilityOptions)
+
+    def _cost(self, mmiPred, shakemap, warningTime, populationDensity, mmiAlertThreshold, filename):
+        """Compute cost savings metrics.
+        """
+        mmiObs = shakemap.data["mmi"]
+        
+        # Compute costNoEEW, costEEW, costPerfectEEW, costSavings
+        fragility = self._fragility()
         
         costDamage = fragility.cost_damage(mmiObs)
         costActionObs = fragility.cost_action(mmiObs)
@@ -110,7 +201,7 @@ class CostSavings(object):
         costPerfectEEW = costDamage*(costDamage < costActionObs) + costActionObs*(costDamage >= costActionObs)
         costEEW = fragility.cost_action(mmiPred)*(mmiPred >= mmiAlertThreshold) + costDamage*(mmiPred < mmiAlertThreshold)
 
-        pixelArea = shakemap.pixel_area(self.config.get("shakemap", "projection"))
+        pixelArea = shakemap.pixel_area(self.config.get("shakemap", "projection"), self.config.get("files", "analysis_cache_dir"))
         areaCostNoEEW = numpy.sum(pixelArea * costNoEEW)
         areaCostPerfectEEW = numpy.sum(pixelArea * costPerfectEEW)
         areaCostEEW = numpy.sum(pixelArea * costEEW)
@@ -163,4 +254,73 @@ class CostSavings(object):
             }
         return metrics
 
+    def _cost_sweep(self, mmiPred, shakemap, populationDensity, mmiThresholds):
+        """Compute cost savings metrics for a sequence of MMI alert thresholds.
+
+        Pixels with predicted MMI at or above a threshold are
+        alerted. We sort the pixels by predicted MMI, so the alerted
+        pixels for each threshold are a suffix of the sorted pixels,
+        and sums over alerted pixels are given by reverse cumulative
+        sums.
+
+        :type mmiThresholds: Numpy array
+        :param mmiThresholds: MMI alert thresholds.
+
+        :returns: List of metrics dictionaries, one per MMI alert threshold.
+        """
+        mmiObs = shakemap.data["mmi"]
+
+        fragility = self._fragility()
+        costDamage = fragility.cost_damage(mmiObs)
+        costActionObs = fragility.cost_action(mmiObs)
+        costActionPred = fragility.cost_action(mmiPred)
+        costNoEEW = costDamage
+        costPerfectEEW = costDamage*(costDamage < costActionObs) + costActionObs*(costDamage >= costActionObs)
+
+        pixelArea = shakemap.pixel_area(self.config.get("shakemap", "projection"), self.config.get("files", "analysis_cache_dir"))
+        areaCostNoEEW = numpy.sum(pixelArea * costNoEEW)
+        areaCostPerfectEEW = numpy.sum(pixelArea * costPerfectEEW)
+        areaDamage = numpy.sum(pixelArea * (costDamage > 0.0))
+        areaAlertPerfect = numpy.sum(pixelArea * (costDamage > costActionObs))
+
+        popCostNoEEW = numpy.sum(populationDensity * pixelArea * costNoEEW)
+        popCostPerfectEEW = numpy.sum(populationDensity * pixelArea * costPerfectEEW)
+        popDamage = numpy.sum(pixelArea * populationDensity * (costDamage > 0.0))
+        popAlertPerfect = numpy.sum(pixelArea * populationDensity * (costDamage > costActionObs))
+
+        # Indices of first alerted pixel in sorted order for each threshold.
+        order = numpy.argsort(mmiPred, kind="stable")
+        thresholds = numpy.asarray(mmiThresholds, dtype=mmiPred.dtype)
+        ialert = numpy.searchsorted(mmiPred[order], thresholds, side="left")
+
+        def sum_alerted(values):
+            """Sum of values over alerted pixels for each threshold.
+            """
+            valuesSorted = values[order]
+            suffixSums = numpy.concatenate((numpy.cumsum(valuesSorted[::-1])[::-1], [0.0]))
+            return suffixSums[ialert]
+
+        # Cost with EEW is cost of damage except at alerted pixels
+        # where it is the cost of action.
+        areaAlert = sum_alerted(pixelArea)
+        areaCostEEW = areaCostNoEEW + sum_alerted(pixelArea * (costActionPred - costDamage))
+        popAlert = sum_alerted(pixelArea * populationDensity)
+        popCostEEW = popCostNoEEW + sum_alerted(populationDensity * pixelArea * (costActionPred - costDamage))
+
+        metrics = []
+        for i in range(thresholds.shape[0]):
+            metrics.append({
+                "area_damage": areaDamage,
+                "area_alert": areaAlert[i],
+                "area_alert_perfect": areaAlertPerfect,
+                "area_costsavings_eew": areaCostNoEEW - areaCostEEW[i],
+                "area_costsavings_perfecteew": areaCostNoEEW - areaCostPerfectEEW,
+                "population_damage": popDamage,
+                "population_alert": popAlert[i],
+                "population_alert_perfect": popAlertPerfect,
+                "population_costsavings_eew": popCostNoEEW - popCostEEW[i],
+                "population_costsavings_perfecteew": popCostNoEEW - popCostPerfectEEW,
+            })
+        return metrics
+
 # End of file
@@ -326,7 +326,7 @@ class SummaryFigures(object):
         areaMetric = []
         popMetric = []
         for fragility, label in FRAGILITIES:
-            perfs = numpy.array([self.db.performance_stats(eqId, server, gmpe, fragility, alertLatency, magThreshold, mmiThreshold) for eqId in self.events]).ravel()
+            perfs = self.db.performance_stats_events(self.events, server, gmpe, fragility, alertLatency, magThreshold, mmiThreshold)
 
             areaMetric.append(numpy.sum(perfs["area_costsavings_eew"]) / numpy.sum(perfs["area_costsavings_perfecteew"]))
             popMetric.append(numpy.sum(perfs["population_costsavings_eew"]) / numpy.sum(perfs["population_costsavings_perfecteew"]))
@@ -390,7 +390,7 @@ class SummaryFigures(object):
         ec = []
         fc = []
         for server, label in servers:
-            perfs = numpy.array([self.db.performance_stats(eqId, server, gmpe, fragility, alertLatency, magThreshold, mmiThreshold) for eqId in self.events]).ravel()
+            perfs = self.db.performance_stats_events(self.events, server, gmpe, fragility, alertLatency, magThreshold, mmiThreshold)
 
             areaMetric.append(numpy.sum(perfs["area_costsavings_eew"]) / numpy.sum(perfs["area_costsavings_perfecteew"]))
             popMetric.append(numpy.sum(perfs["population_costsavings_eew"]) / numpy.sum(perfs["population_costsavings_perfecteew"]))
@@ -476,7 +476,7 @@ class SummaryFigures(object):
         magThresholds = numpy.arange(thresholdStart, thresholdStop+0.1*thresholdStep, thresholdStep)
 
         alertLatency = self.config.getfloat("alerts", "alert_latency_sec")
-        perfs = numpy.array([self.db.performance_stats(eqId, server, gmpe, fragility, alertLatency) for eqId in self.events]).ravel()
+        perfs = self.db.performance_stats_events(self.events, server, gmpe, fragility, alertLatency)
         
         dtype = [
             ("area_metric", "float32",),
@@ -595,14 +595,10 @@ class SummaryFigures(object):
         magThreshold = self.config.getfloat("alerts", "magnitude_threshold")
         alertLatency = self.config.getfloat("alerts", "alert_latency_sec")
         
-        perfs = numpy.array([self.db.performance_stats(eqId, server, gmpe, fragility, alertLatency, magThreshold, mmiThreshold) for eqId in self.events]).ravel()
+        perfs = self.db.performance_stats_events(self.events, server, gmpe, fragility, alertLatency, magThreshold, mmiThreshold)
         
-        originTime = numpy.zeros(perfs.shape, dtype="datetime64[s]")
-        magnitude = numpy.zeros(perfs.shape, dtype=numpy.float32)
-        for i,p in enumerate(perfs):
-            event = self.db.comcat_event(p["comcat_id"].decode())
-            originTime[i] = numpy.datetime64(dateutil.parser.parse(event["origin_time"]))
-            magnitude[i] = event["magnitude"]
+        originTime = perfs["event_origin_time"].astype("datetime64[s]")
+        magnitude = perfs["event_magnitude"].astype(numpy.float32)
         ot = originTime.astype(datetime)
         duration = numpy.max(ot) - numpy.min(ot)
             
@@ -666,12 +662,9 @@ class SummaryFigures(object):
         magThreshold = self.config.getfloat("alerts", "magnitude_threshold")
         alertLatency = self.config.getfloat("alerts", "alert_latency_sec")
         
-        perfs = numpy.array([self.db.performance_stats(eqId, server, gmpe, fragility, alertLatency, magThreshold, mmiThreshold) for eqId in self.events]).ravel()
+        perfs = self.db.performance_stats_events(self.events, server, gmpe, fragility, alertLatency, magThreshold, mmiThreshold)
 
-        magnitude = numpy.zeros(perfs.shape, dtype=numpy.float32)
-        for i,p in enumerate(perfs):
-            event = self.db.comcat_event(p["comcat_id"].decode())
-            magnitude[i] = event["magnitude"]
+        magnitude = perfs["event_magnitude"].astype(numpy.float32)
 
         ms = 5.0e-4 * 10**magnitude
 
@@ -520,7 +520,7 @@ class AnalysisSummary(object):
         alertLatency = self.config.getfloat("alerts", "alert_latency_sec")
         
         db = AnalysisData(self.config.get("files", "analysis_db"))
-        perfs = numpy.array([db.performance_stats(eqId, server, gmpe, fragility, alertLatency, magThreshold, mmiThreshold) for eqId in eqIds]).ravel()
+        perfs = db.performance_stats_events(eqIds, server, gmpe, fragility, alertLatency, magThreshold, mmiThreshold)
 
         from numpy.lib.recfunctions import append_fields
         area_metric = numpy.where(perfs["area_costsavings_perfecteew"] > 0.0, perfs["area_costsavings_eew"] / perfs["area_costsavings_perfecteew"], numpy.nan)
@@ -528,8 +528,8 @@ class AnalysisSummary(object):
         perfs = append_fields(perfs, ("area_metric_eew", "population_metric_eew"), (area_metric, population_metric), dtypes=("float32", "float32"), usemask=False)
 
         alertLatency = 0.0
-        perfsTheoryMag = numpy.array([db.performance_stats(eqId, self.CATALOG_MAGNITUDE, gmpe, fragility, alertLatency, magThreshold, mmiThreshold) for eqId in eqIds]).ravel()
-        perfsTheoryMagBias = numpy.array([db.performance_stats(eqId, self.CATALOG_MAGNITUDE_BIAS, gmpe, fragility, alertLatency, magThreshold, mmiThreshold) for eqId in eqIds]).ravel()
+        perfsTheoryMag = db.performance_stats_events(eqIds, self.CATALOG_MAGNITUDE, gmpe, fragility, alertLatency, magThreshold, mmiThreshold)
+        perfsTheoryMagBias = db.performance_stats_events(eqIds, self.CATALOG_MAGNITUDE_BIAS, gmpe, fragility, alertLatency, magThreshold, mmiThreshold)
 
         theader = [
             [
@@ -567,25 +567,32 @@ class AnalysisSummary(object):
             ("population_costsavings_perfecteew", "{:8.2e}"),
         )
 
+        # Rows of theoretical performance may not line up with perfs, so
+        # we look them up by event.
+        theoryMag = {perf["comcat_id"]: perf for perf in perfsTheoryMag}
+        theoryMagBias = {perf["comcat_id"]: perf for perf in perfsTheoryMagBias}
+
         tdata = []
-        for iperf, perf in enumerate(perfs):
-            event = db.comcat_event(perf["comcat_id"].decode())
-            ot = dateutil.parser.parse(event["origin_time"])
-            row = [s.format(ot=ot, event=event) for s in eventCols]
+        for perf in perfs:
+            ot = perf["event_origin_time"].item()
+            if ot is not None:
+                event = {
+                    "event_id": perf["comcat_id"].decode(),
+                    "magnitude": perf["event_magnitude"],
+                    "description": perf["event_description"],
+                }
+                row = [s.format(ot=ot, event=event) for s in eventCols]
+            else:
+                # Event is missing from ComCat events table.
+                row = [perf["comcat_id"].decode(), "", "", "(ComCat event not found)"]
 
             row += [s.format(perf[v]) for v,s in perfCols]
 
-            if len(perfsTheoryMag) > 0:
-                assert(perfsTheoryMag[iperf]["comcat_id"] == perf["comcat_id"])
-                row += [s.format(perfsTheoryMag[iperf][v]) for v,s in perfTheoryCols]
-            else:
-                row += [""]*len(perfTheoryCols)
-
-            if len(perfsTheoryMagBias) > 0:
-                assert(perfsTheoryMagBias[iperf]["comcat_id"] == perf["comcat_id"])
-                row += [s.format(perfsTheoryMagBias[iperf][v]) for v,s in perfTheoryCols]
-            else:
-                row += [""]*len(perfTheoryCols)
+            for theory in (theoryMag, theoryMagBias):
+                if perf["comcat_id"] in theory:
+                    row += [s.format(theory[perf["comcat_id"]][v]) for v,s in perfTheoryCols]
+                else:
+                    row += [""]*len(perfTheoryCols)
 
             row += [s.format(perf[v]) for v,s in perfPerfectCols]
             tdata.append(row)
@@ -13,7 +13,7 @@ import datetime
 import os
 import gzip
 import logging
-import dateutil
+import dateutil.parser
 from lxml import etree
 
 TIMEOUT_SECS = 30 # How many seconds to wait for download
@@ -22,6 +22,110 @@ DEMONSTRATION_END = datetime.date(year=2016, month=6, day=4)
 PRODUCTION_BEGIN = datetime.date(year=2016, month=6, day=5)
 PRODUCTION_END = datetime.date(year=3000, month=1, day=1)
 
+# Timestamp and XML message in DM XML log.
+DMLOG_BLOCK_RE = re.compile(
+    b"(?P<timestamp>[0-9]{4}-[0-9]+-[0-9]+T[0-9]{2}:[0-9]{2}:[0-9]{2}.[0-9]+Z)[\\s]*"
+    b"(?P<xml>\\<\\?xml[\\s\\S]+?</event_message>)"
+    )
+
+# Start tag of XML message, id of core_info element, and attributes,
+# for filtering messages without parsing them.
+EVENT_MESSAGE_RE = re.compile(b"<event_message\\s([^>]*)>")
+CORE_INFO_ID_RE = re.compile(b"<core_info\\s[^>]*\\bid=\"([^\"]*)\"")
+ATTRIBUTE_RE = re.compile(b"([a-zA-Z_]+)=\"([^\"]*)\"")
+
+# Compiled XPath expressions for child elements of DM XML messages.
+DMLOG_XPATHS = {}
+
+# Increment when the layout of the alerts archive changes.
+ARCHIVE_VERSION = 2
+
+# Fields (name, dtype) in alerts archive.
+ARCHIVE_FIELDS = (
+    ("server", "str"),
+    ("event_id", "int64"),
+    ("category", "str"),
+    ("message_type", "str"),
+    ("timestamp", "datetime64[us]"),
+    ("version", "int32"),
+    ("magnitude", "float64"),
+    ("magnitude_type", "str"),
+    ("latitude", "float64"),
+    ("longitude", "float64"),
+    ("depth_km", "float64"),
+    ("origin_time", "datetime64[us]"),
+    ("num_stations", "int32"),
+    ("likelihood", "float64"),
+    )
+
+# Value of UTC offset field in alerts archive for times without a timezone.
+ARCHIVE_NAIVE_OFFSET = numpy.iinfo(numpy.int32).min
+
+# UTC time in DM logs, YYYY-MM-DDTHH:MM:SS[.ffffff]Z
+TIMESTAMP_RE = re.compile("^[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}(\\.[0-9]{1,6})?Z$")
+
+
+def get_filters(config):
+    """Get filters for DM log messages from configuration.
+
+    The 'shakealert.dmlog' section has comma separated lists of
+    'categories' and 'message_types' to keep, or 'all'.
+
+    :type config: ConfigParser
+    :param config: Configuration for application.
+
+    :returns: Dictionary with filters ["categories", "message_types"], None for all.
+    """
+    filters = {
+        "categories": None,
+        "message_types": None,
+    }
+    if config is None or not config.has_section("shakealert.dmlog"):
+        return filters
+    for name in filters:
+        value = config.get("shakealert.dmlog", name, fallback="all")
+        if value.strip() != "all":
+            filters[name] = tuple([v.strip() for v in value.split(",")])
+    return filters
+
+
+def parse_timestamps(values):
+    """Convert strings with times to datetimes.
+
+    Times in the usual DM log format are converted together as Numpy
+    datetime64 values; other formats are parsed individually using
+    dateutil.
+
+    :type values: list of str
+    :param values: Times as strings.
+
+    :returns: Tuple of list of datetimes (None for invalid times) and
+        number of times parsed with dateutil.
+    """
+    times = [None]*len(values)
+    indicesFast = []
+    indicesSlow = []
+    for index, value in enumerate(values):
+        if TIMESTAMP_RE.match(value):
+            indicesFast.append(index)
+        else:
+            indicesSlow.append(index)
+    if indicesFast:
+        try:
+            timesFast = numpy.array([values[index][:-1] for index in indicesFast], dtype="datetime64[us]").tolist()
+            for index, t in zip(indicesFast, timesFast):
+                times[index] = t.replace(tzinfo=datetime.timezone.utc)
+        except ValueError:
+            # Invalid date in batch, so parse each time individually.
+            indicesSlow += indicesFast
+    for index in indicesSlow:
+        try:
+            times[index] = dateutil.parser.parse(values[index])
+        except (ValueError, OverflowError, TypeError):
+            pass
+    return (times, len(indicesSlow))
+
+
 class EEWServer(object):
     """EEW ShakeAlert server holding status and logs.
     """
@@ -118,13 +222,28 @@ class DMLogXML(object):
     """XML DM log fetcher and parser.
     """
 
-    def __init__(self, config=None, filename=None):
+    CHUNK_SIZE = 4*1024*1024 # Size of chunks (bytes) read from DM log
+
+    def __init__(self, config=None, filename=None, filters=None):
         """Constructor.
 
+        :type config: ConfigParser
+        :param config: Configuration for application.
+
         :type filename: str
         :param filename: Name of file for local storage of DM log.
+
+        :type filters: dict
+        :param filters: Messages to keep ["categories", "message_types"];
+            None keeps all messages. Default is from the 'shakealert.dmlog'
+            section of the configuration, if present.
         """
         self.config = config
+        self.numTimestampFallbacks = 0
+        self.numSkipped = 0
+        if filters is None:
+            filters = get_filters(config)
+        self.filters = filters
         if filename:
             self.load(filename)
         return
@@ -178,30 +297,77 @@ class DMLogXML(object):
 
         :type filename: str
         :param filename: Name of local file with DM log.
+        :returns: List of alerts (dict) in DM log.
+        """
+        return list(self.iter_alerts(filename))
+
+    def iter_alerts(self, filename):
+        """Iterate over alerts in DM log file.
+
+        The file is decompressed and parsed in chunks, so memory use
+        does not depend on the size of the log.
+
+        :type filename: str
+        :param filename: Name of local file with DM log.
+        :returns: Generator of alerts (dict) in DM log.
         """
         suffix = ""
         if not filename.endswith(".gz"):
             suffix = ".gz"
-        with gzip.open(filename+suffix, "r") as fh:
-            alerts = self._parse(fh)
-        return alerts
+        self.numTimestampFallbacks = 0
+        self.numSkipped = 0
+        with gzip.open(filename+suffix, "rb") as fh:
+            for alert in self._parse(fh):
+                yield alert
+        logging.getLogger(__name__).debug("Skipped {:d} messages in {}.".format(self.numSkipped, filename))
+        if self.numTimestampFallbacks > 0:
+            logging.getLogger(__name__).info("Parsed {:d} times with nonstandard format in {}.".format(self.numTimestampFallbacks, filename))
+        return
 
     def _parse(self, fh):
         """Parse DM XML log file.
-        
-        :type lines: str
-        :param lines: Lines from DM log file.
-        :returns: Numpy structured array with DM log contents.
+
+        We search for messages in a buffer holding the unparsed end of
+        the previous chunk and the current chunk. Each message is only
+        matched once its closing tag is in the buffer.
+
+        :type fh: file object
+        :param fh: DM log file opened in binary mode.
+        :returns: Generator of alerts (dict) in DM log.
         """
-        bytes = fh.read()
-        fh.close()
-        pattern = [
-            b"(?P<timestamp>[0-9]{4}-[0-9]+-[0-9]+T[0-9]{2}:[0-9]{2}:[0-9]{2}.[0-9]+Z)[\s]*",
-            b"(?P<xml>\<\?xml[\s\S]+?</event_message>)"
-        ]
-        xmlBlocks = re.findall(b"".join(pattern), bytes)
-        alerts = []
-        for timestamp,xmlBlock in xmlBlocks:
+        buffer = b""
+        while True:
+            chunk = fh.read(self.CHUNK_SIZE)
+            if not chunk:
+                break
+            buffer += chunk
+            iEnd = 0
+            alerts = []
+            for match in DMLOG_BLOCK_RE.finditer(buffer):
+                iEnd = match.end()
+                if self._skipBlock(match.group("xml")):
+                    self.numSkipped += 1
+                    continue
+                alert = self._parseBlock(match.group("timestamp"), match.group("xml"))
+                if alert:
+                    alerts.append(alert)
+            buffer = buffer[iEnd:]
+            for alert in self._decodeTimes(alerts):
+                yield alert
+        return
+
+    def _parseBlock(self, timestamp, xmlBlock):
+        """Parse XML message from DM log.
+
+        :type timestamp: bytes
+        :param timestamp: Time stamp of message in DM log.
+
+        :type xmlBlock: bytes
+        :param xmlBlock: XML message.
+
+        :returns: Alert (dict) or None if message is a test or could not be parsed.
+        """
+        try:
             elMsg = etree.fromstring(xmlBlock.replace(b"UTF-16", b"utf-8"))
             elCoreInfo = self._getChild(elMsg, "core_info")
             elMag = self._getChild(elCoreInfo, "mag")
@@ -209,33 +375,104 @@ class DMLogXML(object):
             # Use time step in message, fallback to time stamp in log.
             if elMsg.get("timestamp"):
                 timestamp = elMsg.get("timestamp")
+            else:
+                timestamp = timestamp.decode("ascii")
+            originTime = self._getChildValue(elCoreInfo, "orig_time")
+            if originTime is None:
+                raise IOError("Expect one 'orig_time' child element in 'core_info' element.")
             if elCoreInfo.get("id").lower().startswith("test"):
-                continue
-            try:
-                alerts.append({
-                    "category": elMsg.get("category"),
-                    "server": elMsg.get("instance").replace("dm@","") if elMsg.get("instance") else "unknown",
-                    "message_type": elMsg.get("message_type"),
-                    "timestamp": dateutil.parser.parse(timestamp),
-                    "version": int(elMsg.get("version")),
+                self.numSkipped += 1
+                return None
+            if not self._keep(elMsg.get("category"), elMsg.get("message_type")):
+                self.numSkipped += 1
+                return None
+            alert = {
+                "category": elMsg.get("category"),
+                "server": elMsg.get("instance").replace("dm@","") if elMsg.get("instance") else "unknown",
+                "message_type": elMsg.get("message_type"),
+                "timestamp": timestamp,
+                "version": int(elMsg.get("version")),
                     
-                    "event_id": int(elCoreInfo.get("id")),
+                "event_id": int(elCoreInfo.get("id")),
                     
-                    "magnitude": float(elMag.text),
-                    "magnitude_type": elMag.get("units"),
+                "magnitude": float(elMag.text),
+                "magnitude_type": elMag.get("units"),
                     
-                    "latitude": self._getChildValue(elCoreInfo, "lat", vtype=float),
-                    "longitude": self._getChildValue(elCoreInfo, "lon", vtype=float),
-                    "depth_km": self._getChildValue(elCoreInfo, "depth", vtype=float),
-                    "origin_time": dateutil.parser.parse(self._getChildValue(elCoreInfo, "orig_time")),
-                    "likelihood": self._getChildValue(elCoreInfo, "likelihood", vtype=float, default=-1),
-                    "num_stations": self._getChildValue(elCoreInfo, "num_stations", vtype=int, default=-1),
-                })
-            except Exception as ex:
-                import pdb
-                pdb.set_trace()
-        return alerts
-        
+                "latitude": self._getChildValue(elCoreInfo, "lat", vtype=float),
+                "longitude": self._getChildValue(elCoreInfo, "lon", vtype=float),
+                "depth_km": self._getChildValue(elCoreInfo, "depth", vtype=float),
+                "origin_time": originTime,
+                "likelihood": self._getChildValue(elCoreInfo, "likelihood", vtype=float, default=-1),
+                "num_stations": self._getChildValue(elCoreInfo, "num_stations", vtype=int, default=-1),
+            }
+        except Exception as ex:
+            logging.getLogger(__name__).warning("Could not parse DM log message with time stamp {}: {}".format(timestamp, ex))
+            return None
+        return alert
+
+    def _skipBlock(self, xmlBlock):
+        """Check whether to skip XML message without parsing it.
+
+        We only look at the attributes of the 'event_message' start tag
+        and the id of 'core_info'. Messages in which we cannot find them
+        are parsed and checked after parsing.
+
+        :type xmlBlock: bytes
+        :param xmlBlock: XML message.
+
+        :returns: True if message is a test or is excluded by filters.
+        """
+        match = CORE_INFO_ID_RE.search(xmlBlock)
+        if match and match.group(1).lower().startswith(b"test"):
+            return True
+        if not self.filters["categories"] and not self.filters["message_types"]:
+            return False
+        match = EVENT_MESSAGE_RE.search(xmlBlock)
+        if not match:
+            return False
+        attributes = dict((name.decode("ascii"), value.decode("utf-8")) for name, value in ATTRIBUTE_RE.findall(match.group(1)))
+        if not "category" in attributes or not "message_type" in attributes:
+            return False
+        return not self._keep(attributes["category"], attributes["message_type"])
+
+    def _keep(self, category, messageType):
+        """Check whether filters keep message.
+
+        :type category: str
+        :param category: Category of message (live, test, etc).
+
+        :type messageType: str
+        :param messageType: Type of message (new, update, delete, etc).
+        """
+        categories = self.filters["categories"]
+        messageTypes = self.filters["message_types"]
+        if categories and not category in categories:
+            return False
+        if messageTypes and not messageType in messageTypes:
+            return False
+        return True
+
+    def _decodeTimes(self, alerts):
+        """Convert time stamps and origin times of alerts from strings to datetimes.
+
+        :type alerts: list of dict
+        :param alerts: Alerts with times as strings.
+
+        :returns: List of alerts with times as datetimes, omitting alerts with invalid times.
+        """
+        numAlerts = len(alerts)
+        values = [alert["timestamp"] for alert in alerts] + [alert["origin_time"] for alert in alerts]
+        (times, numFallback) = parse_timestamps(values)
+        self.numTimestampFallbacks += numFallback
+        decoded = []
+        for alert, timestamp, originTime in zip(alerts, times[:numAlerts], times[numAlerts:]):
+            if timestamp is None or originTime is None:
+                logging.getLogger(__name__).warning("Could not parse times '{}' and '{}' of DM log message.".format(alert["timestamp"], alert["origin_time"]))
+                continue
+            alert["timestamp"] = timestamp
+            alert["origin_time"] = originTime
+            decoded.append(alert)
+        return decoded
 
     def _getChild(self, el, name):
         """Get child element 'name'. Raises IOError if more than one child element with name is found.
@@ -246,9 +483,9 @@ class DMLogXML(object):
         :type name: str
         :param name: Name of child element.
         """
-        elList = el.xpath(name)
+        elList = self._xpath(name)(el)
         if len(elList) != 1:
-            raise IOError("Expect one '{0}' child element in XML element. Found {1} elements in {3}.".format(name, len(elList), el.tag))
+            raise IOError("Expect one '{0}' child element in XML element. Found {1} elements in {2}.".format(name, len(elList), el.tag))
         return elList[0]
 
     def _getChildValue(self, el, name, vtype=str, default=None):
@@ -260,7 +497,7 @@ class DMLogXML(object):
         :type name: str
         :param name: Name of child element.
         """
-        elList = el.xpath(name)
+        elList = self._xpath(name)(el)
         if len(elList) != 1:
             return default
         value =  elList[0].text
@@ -271,8 +508,200 @@ class DMLogXML(object):
             value = int(value)
         return value
 
+    @staticmethod
+    def _xpath(name):
+        """Get compiled XPath expression for child element 'name'.
+
+        :type name: str
+        :param name: Name of child element.
+        """
+        if not name in DMLOG_XPATHS:
+            DMLOG_XPATHS[name] = etree.XPath(name)
+        return DMLOG_XPATHS[name]
+
 
     
+class AlertsArchive(object):
+    """Columnar archive of DM alerts.
+
+    The archive is a directory with one Numpy (.npy) file per field, so
+    fields can be memory-mapped when loaded. String fields are
+    dictionary encoded: we store an integer code for each alert and the
+    distinct strings. Times are stored as UTC datetime64[us] with a
+    field holding the UTC offset in seconds of the original time
+    (ARCHIVE_NAIVE_OFFSET for times without a timezone), so alerts
+    read from the archive are identical to those from the DM log.
+    """
+
+    def __init__(self, columns, values):
+        """Constructor.
+
+        :type columns: dict
+        :param columns: Dictionary of Numpy arrays with fields (ARCHIVE_FIELDS).
+
+        :type values: dict
+        :param values: Dictionary of Numpy arrays with distinct strings for string fields.
+        """
+        self.columns = columns
+        self.values = values
+        return
+
+    def __len__(self):
+        return self.columns["event_id"].shape[0]
+
+    @staticmethod
+    def from_alerts(alerts):
+        """Create archive from alerts.
+
+        :type alerts: list of dict
+        :param alerts: Alerts from DM log.
+
+        :returns: AlertsArchive
+        """
+        columns = {}
+        values = {}
+        for name, dtype in ARCHIVE_FIELDS:
+            if dtype == "str":
+                (values[name], codes) = numpy.unique(numpy.array([alert[name] or "" for alert in alerts], dtype=str), return_inverse=True)
+                columns[name] = codes.astype(numpy.int32)
+            elif dtype == "datetime64[us]":
+                times = [_split_time(alert[name]) for alert in alerts]
+                columns[name] = numpy.array([t for t, offset in times], dtype=dtype)
+                columns[name+"_utc_offset"] = numpy.array([offset for t, offset in times], dtype=numpy.int32)
+            elif dtype == "float64":
+                columns[name] = numpy.array([numpy.nan if alert[name] is None else alert[name] for alert in alerts], dtype=dtype)
+            else:
+                columns[name] = numpy.array([alert[name] for alert in alerts], dtype=dtype)
+        return AlertsArchive(columns, values)
+
+    @staticmethod
+    def load(dirname, mmap=True):
+        """Load archive from directory.
+
+        :type dirname: str
+        :param dirname: Name of archive directory.
+
+        :type mmap: bool
+        :param mmap: If True, memory-map the fields rather than reading them.
+
+        :returns: AlertsArchive
+        """
+        version = int(numpy.load(os.path.join(dirname, "archive_version.npy")))
+        if version != ARCHIVE_VERSION:
+            raise ValueError("Alerts archive '{}' has version {}, expected version {}. Rebuild the archive.".format(dirname, version, ARCHIVE_VERSION))
+        mmapMode = "r" if mmap else None
+        columns = {}
+        values = {}
+        for name, dtype in ARCHIVE_FIELDS:
+            columns[name] = numpy.load(os.path.join(dirname, name+".npy"), mmap_mode=mmapMode)
+            if dtype == "datetime64[us]":
+                columns[name+"_utc_offset"] = numpy.load(os.path.join(dirname, name+"_utc_offset.npy"), mmap_mode=mmapMode)
+            if dtype == "str":
+                values[name] = numpy.load(os.path.join(dirname, name+"_values.npy"))
+        return AlertsArchive(columns, values)
+
+    def save(self, dirname):
+        """Save archive to directory, replacing any existing archive.
+
+        :type dirname: str
+        :param dirname: Name of archive directory.
+        """
+        import tempfile
+        import shutil
+
+        parent = os.path.dirname(os.path.normpath(dirname)) or "."
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        tmpDirname = tempfile.mkdtemp(dir=parent)
+        numpy.save(os.path.join(tmpDirname, "archive_version.npy"), ARCHIVE_VERSION)
+        for name, dtype in ARCHIVE_FIELDS:
+            numpy.save(os.path.join(tmpDirname, name+".npy"), self.columns[name])
+            if dtype == "datetime64[us]":
+                numpy.save(os.path.join(tmpDirname, name+"_utc_offset.npy"), self.columns[name+"_utc_offset"])
+            if dtype == "str":
+                numpy.save(os.path.join(tmpDirname, name+"_values.npy"), self.values[name])
+        if os.path.isdir(dirname):
+            shutil.rmtree(dirname)
+        os.rename(tmpDirname, dirname)
+        return
+
+    def column(self, name):
+        """Get field with strings decoded.
+
+        :type name: str
+        :param name: Name of field.
+
+        :returns: Numpy array with field values.
+        """
+        if name in self.values:
+            return self.values[name][self.columns[name]]
+        return self.columns[name]
+
+    def alerts(self, batchSize=10000):
+        """Iterate over alerts in archive.
+
+        Alerts have the same form as those from DMLogXML.
+
+        :type batchSize: int
+        :param batchSize: Number of alerts converted at a time.
+
+        :returns: Generator of alerts (dict).
+        """
+        names = [name for name, dtype in ARCHIVE_FIELDS]
+        for iStart in range(0, len(self), batchSize):
+            fields = []
+            for name, dtype in ARCHIVE_FIELDS:
+                column = self.column(name)[iStart:iStart+batchSize].tolist()
+                if dtype == "str":
+                    column = [value or None for value in column]
+                elif dtype == "datetime64[us]":
+                    offsets = self.columns[name+"_utc_offset"][iStart:iStart+batchSize].tolist()
+                    column = [_join_time(value, offset) for value, offset in zip(column, offsets)]
+                elif dtype == "float64":
+                    column = [None if numpy.isnan(value) else value for value in column]
+                fields.append(column)
+            for row in zip(*fields):
+                yield dict(zip(names, row))
+        return
+
+
+def archive_dirname(archiveDir, year, month):
+    """Get name of archive directory for DM alerts in month.
+
+    :type archiveDir: str
+    :param archiveDir: Directory with archives.
+
+    :type year: int
+    :param year: Year of DM logs.
+
+    :type month: int
+    :param month: Month of DM logs.
+    """
+    return os.path.join(archiveDir, "dmalerts_{:04d}{:02d}".format(year, month))
+
+
+def _split_time(value):
+    """Split datetime into naive UTC datetime and UTC offset in seconds.
+
+    Times without a timezone are kept as is with offset ARCHIVE_NAIVE_OFFSET.
+    """
+    offset = value.utcoffset()
+    if offset is None:
+        return (value.replace(tzinfo=None), ARCHIVE_NAIVE_OFFSET)
+    return (value.astimezone(datetime.timezone.utc).replace(tzinfo=None), int(offset.total_seconds()))
+
+
+def _join_time(value, offset):
+    """Convert naive UTC datetime and UTC offset in seconds to datetime.
+    """
+    if offset == ARCHIVE_NAIVE_OFFSET:
+        return value
+    if offset == 0:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    delta = datetime.timedelta(seconds=offset)
+    return (value + delta).replace(tzinfo=datetime.timezone(delta))
+
+
 class DMLogASCII(object):
     """DM log fetcher and parser.
     """
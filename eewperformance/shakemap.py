@@ -6,17 +6,109 @@
 # ======================================================================
 #
 
+import os
 import gzip
-import io
+import json
+import hashlib
 import numpy
 import logging
+import collections
 from lxml import etree
 
-from .openquake_gmpe import OpenQuakeGMPE
+# Relative tolerance for using one pixel area per latitude row. This
+# is comparable to the error in the rhombus approximation of the
+# pixel area for grids within a few degrees of the projection's
+# central meridian.
+PIXEL_AREA_TOLERANCE = 1.0e-3
+
+# Pixel areas memoized by grid and projection, least recently used
+# first, and the maximum number of bytes of pixel areas kept.
+PIXEL_AREA_CACHE = collections.OrderedDict()
+PIXEL_AREA_CACHE_BYTES = 256*1024**2
+
+class RegularGrid(object):
+    """ShakeMap values on a regular longitude/latitude grid.
+
+    Values are stored as 2-D float32 arrays (latitude, longitude) in
+    the ShakeMap point order (north to south, west to east) along
+    with the 1-D longitude and latitude coordinate axes. Indexing with
+    a field name returns a flattened view of the values, so a
+    RegularGrid can be used wherever a structured array of points is
+    expected. The longitude and latitude of every point are only
+    created when requested.
+    """
+
+    def __init__(self, longitude, latitude, fields):
+        """Constructor.
+
+        :type longitude: Numpy array
+        :param longitude: Longitude of grid columns (west to east).
+
+        :type latitude: Numpy array
+        :param latitude: Latitude of grid rows (north to south).
+
+        :type fields: dict
+        :param fields: Dictionary of field name and Numpy array of values.
+        """
+        self.longitude = longitude
+        self.latitude = latitude
+        self.shape = (latitude.shape[0], longitude.shape[0],)
+        self.fields = {name: value.reshape(self.shape) for name, value in fields.items()}
+        self._coordinates = {}
+        return
+
+    @staticmethod
+    def from_points(values, numLon, numLat):
+        """Create regular grid from values at points.
+
+        :type values: dict
+        :param values: Dictionary of field name and Numpy array of values at points, including 'longitude' and 'latitude'.
+
+        :type numLon: int
+        :param numLon: Number of points along longitude direction.
+
+        :type numLat: int
+        :param numLat: Number of points along latitude direction.
+
+        :returns: RegularGrid or None if the points are not on a regular grid.
+        """
+        lon = values["longitude"].reshape((numLat, numLon))
+        lat = values["latitude"].reshape((numLat, numLon))
+        if not numpy.all(lon == lon[0,:]) or not numpy.all(lat == lat[:,0:1]):
+            return None
+        fields = {name: value for name, value in values.items() if not name in ("longitude", "latitude")}
+        return RegularGrid(lon[0,:].copy(), lat[:,0].copy(), fields)
+
+    def axes(self):
+        """Get coordinate axes of grid.
+
+        :returns: Tuple of longitude (west to east) and latitude (north to south) axes.
+        """
+        return (self.longitude, self.latitude,)
+
+    def __len__(self):
+        return self.shape[0] * self.shape[1]
+
+    def __getitem__(self, name):
+        if name == "longitude" or name == "latitude":
+            if not name in self._coordinates:
+                lon, lat = numpy.meshgrid(self.longitude, self.latitude)
+                self._coordinates = {
+                    "longitude": lon.ravel(),
+                    "latitude": lat.ravel(),
+                }
+            return self._coordinates[name]
+        return self.fields[name].ravel()
+
+    def __setitem__(self, name, value):
+        self.fields[name] = numpy.asarray(value, dtype=numpy.float32).reshape(self.shape)
+        return
+
 
 class ShakeMap(object):
     """ShakeMap reader.
     """
+    CACHE_VERSION = 2
 
     def __init__(self, gmice=None):
         """Constructor.
@@ -25,21 +117,58 @@ class ShakeMap(object):
         self.grid = None
         self.gmice = gmice
         self.gmice_internal = None
+        self._gridKey = None
         return
 
-    def load(self, filename):
+    def load(self, filename, cacheDir=None):
         """Load ShakeMap grid file.
 
+        If a cache directory is given, the parsed grid is stored there
+        in binary form keyed by the hash of the grid file and the
+        GMICE, so that subsequent loads memory-map the arrays instead
+        of parsing the XML.
+
         :type filename: str
         :param filename: Name of local file with ShakeMap grid data.
+
+        :type cacheDir: str
+        :param cacheDir: Directory for binary cache of parsed grid (None for no cache).
         """
         suffix = ""
         if not filename.endswith(".gz"):
             suffix = ".gz"
-        with gzip.open(filename+suffix, "r") as fh:
+        filename += suffix
+        self._gridKey = None
+        if cacheDir:
+            key = self._cache_key(filename)
+            if self._load_cache(cacheDir, key):
+                return
+        with gzip.open(filename, "r") as fh:
             self._parse(fh)
+        if cacheDir:
+            self._save_cache(cacheDir, key)
         return
 
+    def grid_key(self):
+        """Get key identifying the grid and site conditions of the ShakeMap.
+
+        The key is a hash of the grid specification, the coordinates
+        of the points, and Vs30, so ShakeMaps with identical grids
+        have the same key.
+        """
+        if self._gridKey is None:
+            h = hashlib.sha1()
+            h.update(json.dumps(self.grid, sort_keys=True).encode("utf-8"))
+            if isinstance(self.data, RegularGrid):
+                for axis in self.data.axes():
+                    h.update(numpy.ascontiguousarray(axis).tobytes())
+            else:
+                h.update(numpy.ascontiguousarray(self.data["longitude"]).tobytes())
+                h.update(numpy.ascontiguousarray(self.data["latitude"]).tobytes())
+            h.update(numpy.ascontiguousarray(self.data["vs30"]).tobytes())
+            self._gridKey = h.hexdigest()
+        return self._gridKey
+
     def num_lon(self):
         """Get number of points along longitude direction.
         """
@@ -81,11 +210,73 @@ class ShakeMap(object):
         originLat = self.grid["latitude_max"] + 0.5*dLat
         return (originLon, dLon, 0, originLat, 0, dLat,)
 
-    def pixel_area(self, projection):
+    def pixel_area(self, projection, cacheDir=None):
         """Get pixel area of points in lon/lat grid.
 
         We project the points and compute the area assume the grid is
         a rhomus in the projected coordinate system.
+
+        Pixel areas are memoized by grid coordinates and projection,
+        so they are shared by all ShakeMaps with identical grids in a
+        process. Areas that depend only on latitude are stored as one
+        area per row and expanded to all pixels when requested. The
+        least recently used areas are removed when the memoized areas
+        exceed PIXEL_AREA_CACHE_BYTES. If a cache directory is given,
+        they are also stored on disk.
+        
+        :type projection: str
+        :param projection: Name of projection in the form EPSF:XXXX.
+
+        :type cacheDir: str
+        :param cacheDir: Directory for cache of pixel areas (None for no disk cache).
+        """
+        key = self._pixel_area_key(projection)
+        area = PIXEL_AREA_CACHE.pop(key, None)
+        if area is None:
+            filename = os.path.join(cacheDir, "pixel_area-"+key+".npy") if cacheDir else None
+            if filename and os.path.isfile(filename):
+                area = numpy.load(filename)
+            else:
+                area = self._compute_pixel_area(projection)
+                if filename:
+                    if not os.path.isdir(cacheDir):
+                        os.makedirs(cacheDir)
+                    numpy.save(filename, area)
+        PIXEL_AREA_CACHE[key] = area
+        while len(PIXEL_AREA_CACHE) > 1 and sum([value.nbytes for value in PIXEL_AREA_CACHE.values()]) > PIXEL_AREA_CACHE_BYTES:
+            PIXEL_AREA_CACHE.popitem(last=False)
+
+        if area.ndim == 2:
+            # One area per latitude row.
+            return numpy.repeat(area[:,0], self.num_lon())
+        return area
+    
+    def _pixel_area_key(self, projection):
+        """Get key for cache of pixel areas.
+
+        :type projection: str
+        :param projection: Name of projection in the form EPSF:XXXX.
+        """
+        h = hashlib.sha1()
+        h.update(json.dumps(self.grid, sort_keys=True).encode("utf-8"))
+        h.update(projection.encode("utf-8"))
+        if isinstance(self.data, RegularGrid):
+            for axis in self.data.axes():
+                h.update(numpy.ascontiguousarray(axis).tobytes())
+        else:
+            h.update(numpy.ascontiguousarray(self.data["longitude"]).tobytes())
+            h.update(numpy.ascontiguousarray(self.data["latitude"]).tobytes())
+        return h.hexdigest()
+
+    def _compute_pixel_area(self, projection):
+        """Compute pixel area of points in lon/lat grid.
+
+        For a regular grid, we compute the area of the pixels in the
+        first, middle, and last columns of each row. If these agree
+        within PIXEL_AREA_TOLERANCE, then the area depends only on
+        latitude and we return one area per row as an array with
+        shape (numLat, 1); otherwise, we compute the area of every
+        pixel.
         
         :type projection: str
         :param projection: Name of projection in the form EPSF:XXXX.
@@ -95,51 +286,208 @@ class ShakeMap(object):
         
         srs = osr.SpatialReference()
         srs.ImportFromEPSG(int(projection.replace("EPSG:","")))
-        return greatcircle.area_km2(self.data["longitude"], self.data["latitude"], self.grid["longitude_spacing"], self.grid["latitude_spacing"], srs)        
-    
-    def _parse(self, fh):
+        dLon = self.grid["longitude_spacing"]
+        dLat = self.grid["latitude_spacing"]
+
+        if isinstance(self.data, RegularGrid):
+            lonAxis, latAxis = self.data.axes()
+            numLat, numLon = self.data.shape
+            lon = numpy.tile(lonAxis[[0, numLon//2, numLon-1]], numLat)
+            lat = numpy.repeat(latAxis, 3)
+            areaSamples = greatcircle.area_km2(lon, lat, dLon, dLat, srs).reshape((numLat, 3))
+            areaRow = areaSamples[:,1]
+            if numpy.max(numpy.abs(areaSamples - areaRow[:,numpy.newaxis])) <= PIXEL_AREA_TOLERANCE*numpy.max(areaRow):
+                return areaRow.reshape((numLat, 1))
+            logging.getLogger(__name__).debug("Pixel area varies along rows for projection {}. Computing area of every pixel.".format(projection))
+        return greatcircle.area_km2(self.data["longitude"], self.data["latitude"], dLon, dLat, srs)
+
+    def _cache_key(self, filename):
+        """Get key for binary cache of parsed grid.
+
+        :type filename: str
+        :param filename: Name of local file with ShakeMap grid data.
+        :returns: Hex digest of grid file contents, GMICE, and cache version.
+        """
+        BLOCK_SIZE = 2**20
+        
+        h = hashlib.sha1()
+        with open(filename, "rb") as fh:
+            for block in iter(lambda: fh.read(BLOCK_SIZE), b""):
+                h.update(block)
+        gmiceName = self.gmice.__name__ if self.gmice else "None"
+        h.update("gmice={} version={}".format(gmiceName, self.CACHE_VERSION).encode("utf-8"))
+        return h.hexdigest()
+
+    def _load_cache(self, cacheDir, key):
+        """Load parsed grid from binary cache.
+
+        :type cacheDir: str
+        :param cacheDir: Directory with binary cache of parsed grids.
+
+        :type key: str
+        :param key: Cache key for grid.
+        :returns: True if grid was loaded from cache, False otherwise.
+        """
+        entryDir = os.path.join(cacheDir, "grid-"+key)
+        if not os.path.isfile(os.path.join(entryDir, "grid.json")):
+            return False
+        with open(os.path.join(entryDir, "grid.json"), "r") as fh:
+            info = json.load(fh)
+        self.grid = info["grid"]
+        load = lambda name: numpy.load(os.path.join(entryDir, name+".npy"), mmap_mode="c")
+        if info["regular"]:
+            fields = {name: load(name) for name in info["fields"]}
+            self.data = RegularGrid(load("longitude_axis"), load("latitude_axis"), fields)
+        else:
+            self.data = load("data")
+        logging.getLogger(__name__).debug("Loaded ShakeMap grid from cache {}.".format(entryDir))
+        return True
+
+    def _save_cache(self, cacheDir, key):
+        """Save parsed grid to binary cache.
+
+        The cache entry is written to a temporary directory and then
+        renamed, so concurrent processes never see a partial entry.
+
+        :type cacheDir: str
+        :param cacheDir: Directory with binary cache of parsed grids.
+
+        :type key: str
+        :param key: Cache key for grid.
+        """
+        import tempfile
+        import shutil
+        
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        entryDir = os.path.join(cacheDir, "grid-"+key)
+        tmpDir = tempfile.mkdtemp(dir=cacheDir)
+        save = lambda name, value: numpy.save(os.path.join(tmpDir, name+".npy"), numpy.ascontiguousarray(value))
+        info = {
+            "grid": self.grid,
+            "regular": isinstance(self.data, RegularGrid),
+        }
+        if info["regular"]:
+            info["fields"] = list(self.data.fields.keys())
+            save("longitude_axis", self.data.longitude)
+            save("latitude_axis", self.data.latitude)
+            for name, value in self.data.fields.items():
+                save(name, value)
+        else:
+            save("data", self.data)
+        with open(os.path.join(tmpDir, "grid.json"), "w") as fh:
+            json.dump(info, fh)
+        try:
+            os.rename(tmpDir, entryDir)
+        except OSError:
+            # Another process created the entry first.
+            shutil.rmtree(tmpDir, ignore_errors=True)
+        return
 
+    def _parse(self, fh):
         """Parse ShakeMap grid XML file.
+
+        The XML header is parsed incrementally to get the grid
+        specification and grid fields. The grid data are then decoded
+        in fixed-size chunks directly into preallocated float32
+        columns, so we never hold the full text of the grid data in
+        memory.
+
+        Points on a regular grid (the usual case) are stored as a
+        RegularGrid; otherwise, we fall back to a structured array
+        with the longitude and latitude of every point.
         
         :type fh: File handle
         :param fh: File handle to ShakeMap grid XML file.
         :returns: Numpy structured array with ShakeMap grid data.
         """
-        NS = "http://earthquake.usgs.gov/eqcenter/shakemap"
-        namespaces = {"ns": NS}
-        
-        bytes = fh.read()
-        elRoot = etree.fromstring(bytes)
-
-        # Grid specification
-        elGrid = elRoot.xpath("ns:grid_specification", namespaces=namespaces)[0]
-        self.grid = {
-            "longitude_min": float(elGrid.get("lon_min")),
-            "longitude_max": float(elGrid.get("lon_max")),
-            "latitude_min": float(elGrid.get("lat_min")),
-            "latitude_max": float(elGrid.get("lat_max")),
-            "longitude_spacing": float(elGrid.get("nominal_lon_spacing")),
-            "latitude_spacing": float(elGrid.get("nominal_lat_spacing")),
-            "num_longitude": int(elGrid.get("nlon")),
-            "num_latitude": int(elGrid.get("nlat")),
-        }
-        
+        CHUNK_SIZE = 2**22
+        TAG_BEGIN = b"<grid_data>"
+        TAG_END = b"</grid_data>"
+        COLUMNS = (
+            ("longitude", "LON",),
+            ("latitude", "LAT",),
+            ("mmi", "MMI",),
+            ("pga", "PGA",),
+            ("pgv", "PGV",),
+            ("vs30", "SVEL",),
+        )
+
+        # Read XML header through beginning of grid data.
+        header = b""
+        while header.find(TAG_BEGIN) < 0:
+            block = fh.read(CHUNK_SIZE)
+            if not block:
+                raise IOError("Could not find grid_data in ShakeMap grid file.")
+            header += block
+        index = header.find(TAG_BEGIN)
+        pending = header[index+len(TAG_BEGIN):]
+        header = header[:index]
+
+        parser = etree.XMLPullParser(events=("end",))
+        parser.feed(header)
+        fieldIndices = {}
+        for action, el in parser.read_events():
+            tag = etree.QName(el).localname
+            if tag == "grid_specification":
+                self.grid = {
+                    "longitude_min": float(el.get("lon_min")),
+                    "longitude_max": float(el.get("lon_max")),
+                    "latitude_min": float(el.get("lat_min")),
+                    "latitude_max": float(el.get("lat_max")),
+                    "longitude_spacing": float(el.get("nominal_lon_spacing")),
+                    "latitude_spacing": float(el.get("nominal_lat_spacing")),
+                    "num_longitude": int(el.get("nlon")),
+                    "num_latitude": int(el.get("nlat")),
+                }
+            elif tag == "grid_field":
+                fieldIndices[el.get("name")] = int(el.get("index"))-1
+        numFields = len(fieldIndices)
+
         # Grid values
-        lonIndex = int(elRoot.xpath("ns:grid_field[@name='LON']", namespaces=namespaces)[0].get("index"))-1
-        latIndex = int(elRoot.xpath("ns:grid_field[@name='LAT']", namespaces=namespaces)[0].get("index"))-1
-        mmiIndex = int(elRoot.xpath("ns:grid_field[@name='MMI']", namespaces=namespaces)[0].get("index"))-1
-        pgaIndex = int(elRoot.xpath("ns:grid_field[@name='PGA']", namespaces=namespaces)[0].get("index"))-1
-        pgvIndex = int(elRoot.xpath("ns:grid_field[@name='PGV']", namespaces=namespaces)[0].get("index"))-1
-        vs30Index = int(elRoot.xpath("ns:grid_field[@name='SVEL']", namespaces=namespaces)[0].get("index"))-1
-        colIndices = (lonIndex, latIndex, mmiIndex, pgaIndex, pgvIndex, vs30Index)
-        colNames = "longitude, latitude, mmi, pga, pgv, vs30"
-        colFormats = "float32, float32, float32, float32, float32, float32"
-
-        from six import u as unicode
-        data = numpy.loadtxt(io.StringIO(unicode(elRoot.xpath("ns:grid_data", namespaces=namespaces)[0].text)), usecols=colIndices)
-        self.data = numpy.core.records.fromarrays(data.transpose(), names=colNames, formats=colFormats)
+        numPoints = self.grid["num_longitude"] * self.grid["num_latitude"]
+        columns = {name: numpy.zeros(numPoints, dtype=numpy.float32) for name, field in COLUMNS}
+        ipoint = 0
+        while pending is not None:
+            iend = pending.find(TAG_END)
+            if iend >= 0:
+                rows = pending[:iend]
+                pending = None
+            else:
+                block = fh.read(CHUNK_SIZE)
+                if not block:
+                    raise IOError("Could not find end of grid_data in ShakeMap grid file.")
+                pending += block
+                if pending.find(TAG_END) >= 0:
+                    continue
+                inewline = pending.rfind(b"\n")
+                rows = pending[:inewline+1]
+                pending = pending[inewline+1:]
+            if not rows.strip():
+                continue
+
+            values = numpy.fromstring(rows, dtype=numpy.float64, sep=" ")
+            if values.shape[-1] % numFields != 0:
+                raise IOError("Inconsistent number of values in ShakeMap grid data.")
+            values = values.reshape((-1, numFields))
+            npts = values.shape[0]
+            if ipoint + npts > numPoints:
+                raise IOError("Number of points in ShakeMap grid data exceeds grid specification ({}).".format(numPoints))
+            for name, field in COLUMNS:
+                columns[name][ipoint:ipoint+npts] = values[:,fieldIndices[field]]
+            ipoint += npts
+        if ipoint != numPoints:
+            raise IOError("Found {} points in ShakeMap grid data; expected {}.".format(ipoint, numPoints))
+
         if self.gmice:
-            self.data["mmi"] = self.gmice(self.data["pga"], self.data["pgv"])
+            columns["mmi"][:] = self.gmice(columns["pga"], columns["pgv"])
+
+        self.data = RegularGrid.from_points(columns, self.grid["num_longitude"], self.grid["num_latitude"])
+        if self.data is None:
+            logging.getLogger(__name__).info("ShakeMap points are not on a regular grid. Storing coordinates of every point.")
+            self.data = numpy.zeros(numPoints, dtype=[(name, "float32",) for name, field in COLUMNS])
+            for name, field in COLUMNS:
+                self.data[name] = columns[name]
         return
         
 
@@ -225,7 +573,7 @@ def mmi_AllenEtal2012(event, points, options):
     SLOPE = 0.062 # Vs30 = 400 m/s
     ALPHA = -8.54
 
-    distKm = 1.0e-3 * greatcircle.distance(event["longitude"], event["latitude"], points["longitude"], points["latitude"])
+    distKm = 1.0e-3 * greatcircle.distance_points(event["longitude"], event["latitude"], points)
 
     if options["distance_metric"] == "Rrup":
         C0 = 3.950
@@ -273,12 +621,62 @@ def mmi_via_gmpe_gmice(alert, points, gmpe="ASK2014", gmice="WaldEtal1999"):
     :type options: dict
     :param options: Config options for GMPE.
     """
+    from . import openquake_gmpe
+    oqGMPE = openquake_gmpe.get_gmpe(gmpe)
+    values = oqGMPE.computeMean(alert, points)
+    return _mmi_from_pgm(values, gmice)
+
+
+def mmi_via_gmpe_gmice_radial(alert, points, gmpe="ASK2014", gmice="WaldEtal1999"):
+    """Get predicted MMI for given alert evaluating GMPE on a table of
+    Joyner-Boore distance and Vs30.
+
+    Same as mmi_via_gmpe_gmice() but uses
+    OpenQuakeGMPE.computeMeanRadial(), which evaluates the GMPE at a
+    few thousand sites instead of every point.
+
+    :type alert: dict
+    :param alert: ShakeAlert alert dictionary (from AnalysisData).
+
+    :type points: Numpy structured array
+    :param points: Array with 'longitude', 'latitude', and 'vs30' at points.
+    """
+    from . import openquake_gmpe
+    oqGMPE = openquake_gmpe.get_gmpe(gmpe)
+    values = oqGMPE.computeMeanRadial(alert, points)
+    return _mmi_from_pgm(values, gmice)
+
+
+def mmi_via_table(alert, points, gmpe="ASK2014", gmice="WaldEtal1999"):
+    """Get predicted MMI for given alert using precomputed GMPE table.
+
+    Same as mmi_via_gmpe_gmice() but interpolates ground motions from
+    a table generated by generate_gmpe_tables.py, so OpenQuake is not
+    needed at runtime.
+
+    :type alert: dict
+    :param alert: ShakeAlert alert dictionary (from AnalysisData).
+
+    :type points: Numpy structured array
+    :param points: Array with 'longitude', 'latitude', and 'vs30' at points.
+    """
+    from . import gmpe_tables
+    values = gmpe_tables.get_table(gmpe).computeMean(alert, points)
+    return _mmi_from_pgm(values, gmice)
+
+
+def _mmi_from_pgm(values, gmice):
+    """Convert RotD50 PGA/PGV to MMI using GMICE.
+
+    :type values: Numpy structured array
+    :param values: Array with 'pgaG' and 'pgvCmps'.
+
+    :type gmice: str
+    :param gmice: Name of GMICE.
+    """
     ROTD50_TO_PGA_LARGER = 1.1
     ROTD50_TO_PGV_LARGER = 1.0
     
-    oqGMPE = OpenQuakeGMPE(gmpe)
-    values = oqGMPE.computeMean(alert, points)
-
     values["pgaG"] *= ROTD50_TO_PGA_LARGER
     values["pgvCmps"] *= ROTD50_TO_PGV_LARGER
 
@@ -30,7 +30,7 @@ def shaking_time_vs(event, points, options):
     originLat = event["latitude"]
     originDepth = event["depth_km"]*1.0e+3
 
-    distHoriz = greatcircle.distance(originLon, originLat, points["longitude"], points["latitude"])
+    distHoriz = greatcircle.distance_points(originLon, originLat, points)
     dist = (distHoriz**2 + originDepth**2)**0.5
     shakingTime = originTime + numpy.array(SEC_TO_MSEC*dist/vs, dtype="timedelta64[ms]")
     return shakingTime
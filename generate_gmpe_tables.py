@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#
+# ======================================================================
+#
+#                           Brad T. Aagaard
+#                        U.S. Geological Survey
+#
+# ======================================================================
+#
+
+import logging
+import numpy
+
+from eewperformance import gmpe_tables
+
+DEFAULTS = u"""
+[gmpe_tables]
+gmpes = BSSA2014, ASK2014, CB2014, CY2014
+tables_dir = None
+
+[magnitude]
+min = 2.0
+max = 8.0
+step = 0.1
+
+[depth]
+min_km = 0.0
+max_km = 40.0
+step_km = 2.0
+
+[distance]
+max_km = 1000.0
+# Number of distances per natural log unit of (rjb + 1 km)
+num_per_log_unit = 8
+
+[vs30]
+min_mps = 100.0
+max_mps = 2000.0
+num = 24
+"""
+
+# ----------------------------------------------------------------------
+
+class GMPETablesApp(object):
+    """
+    Generate lookup tables of ground motions over magnitude, depth,
+    Joyner-Boore distance, and Vs30 for OpenQuake GMPEs.
+    """
+
+    def __init__(self):
+        """Constructor.
+        """
+        self.params = None
+        self.showProgress = False
+        return
+
+    def main(self):
+        """Main entry point.
+        """
+        # Initialization
+        args = self._parseCommandLine()
+        logLevel = logging.DEBUG if args.debug else logging.INFO
+        logging.basicConfig(level=logLevel, filename="generate_gmpe_tables.log")
+        if args.show_progress:
+            self.showProgress = True
+        self.initialize(args.config)
+
+        if args.show_parameters or args.all:
+            self.show_parameters()
+
+        if args.generate or args.all:
+            self.generate()
+        return
+
+    def initialize(self, config_filenames):
+        """Set parameters from config file and DEFAULTS.
+
+        :type config_filename: str
+        :param config_filename: Name of configuration (INI) file with parameters.
+        """
+        import configparser
+        config = configparser.ConfigParser()
+        config.read_string(DEFAULTS)
+        if config_filenames:
+            for filename in config_filenames.split(","):
+                if self.showProgress:
+                    print("Fetching parameters from %s..." % filename)
+                config.read(filename)
+
+        self.params = config
+
+        return
+
+    def show_parameters(self):
+        """Write parameters to stdout.
+        """
+        import sys
+        self.params.write(sys.stdout)
+        return
+
+    def generate(self):
+        """Generate tables for GMPEs.
+        """
+        magnitudes = self._axis("magnitude", "min", "max", "step")
+        depths = self._axis("depth", "min_km", "max_km", "step_km")
+
+        maxDistKm = self.params.getfloat("distance", "max_km")
+        numPerUnit = self.params.getint("distance", "num_per_log_unit")
+        logMax = numpy.log(maxDistKm + gmpe_tables.DIST_OFFSET_KM)
+        logMin = numpy.log(gmpe_tables.DIST_OFFSET_KM)
+        numDist = int(numpy.ceil((logMax-logMin)*numPerUnit)) + 1
+        distances = numpy.exp(numpy.linspace(logMin, logMax, numDist)) - gmpe_tables.DIST_OFFSET_KM
+
+        vs30Min = self.params.getfloat("vs30", "min_mps")
+        vs30Max = self.params.getfloat("vs30", "max_mps")
+        numVs30 = self.params.getint("vs30", "num")
+        vs30s = numpy.exp(numpy.linspace(numpy.log(vs30Min), numpy.log(vs30Max), numVs30))
+
+        tablesDir = self.params.get("gmpe_tables", "tables_dir")
+        if tablesDir == "None":
+            tablesDir = None
+        for gmpe in [s.strip() for s in self.params.get("gmpe_tables", "gmpes").split(",")]:
+            filename = gmpe_tables.table_filename(gmpe, tablesDir)
+            if self.showProgress:
+                print("Generating table for {} ({} magnitudes, {} depths, {} distances, {} Vs30)...".format(gmpe, magnitudes.shape[0], depths.shape[0], distances.shape[0], vs30s.shape[0]))
+            table = gmpe_tables.GMPETable.build(gmpe, magnitudes, depths, distances, vs30s)
+            table.save(filename)
+            logging.getLogger(__name__).info("Wrote GMPE table '{}'.".format(filename))
+        return
+
+    def _axis(self, section, labelMin, labelMax, labelStep):
+        """Get uniformly spaced axis from parameters.
+        """
+        valueMin = self.params.getfloat(section, labelMin)
+        valueMax = self.params.getfloat(section, labelMax)
+        valueStep = self.params.getfloat(section, labelStep)
+        num = int(round((valueMax-valueMin)/valueStep)) + 1
+        return numpy.linspace(valueMin, valueMax, num)
+
+    def _parseCommandLine(self):
+        """Parse command line arguments.
+        """
+        import argparse
+
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--config", action="store", dest="config")
+        parser.add_argument("--show-parameters", action="store_true", dest="show_parameters")
+        parser.add_argument("--generate", action="store_true", dest="generate")
+        parser.add_argument("--all", action="store_true", dest="all")
+        parser.add_argument("--quiet", action="store_false", dest="show_progress", default=True)
+        parser.add_argument("--debug", action="store_true", dest="debug")
+        return parser.parse_args()
+
+
+# ======================================================================
+if __name__ == "__main__":
+    GMPETablesApp().main()
+
+
+# End of file